@@ -0,0 +1,63 @@
+import argparse
+import time
+import torch
+
+from src.agents.nn_models import EnsembleLinear, EnsembleMLP, DoubleQNetwork, EnsembleQNetwork
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra op threads, 0 keeps the torch default, default=0")
+    parser.add_argument("--rollout_batch_size", type=int, default=50000, help="dynamics rollout batch size, default=50000")
+    parser.add_argument("--batch_size", type=int, default=256, help="critic training batch size, default=256")
+    parser.add_argument("--num_repeats", type=int, default=20, help="number of timed repeats, default=20")
+    arglist = parser.parse_args()
+    return arglist
+
+def reference_forward(model, x):
+    """ Ensemble mlp forward with the input repeated for every member """
+    x = x.unsqueeze(-2).repeat_interleave(model.ensemble_dim, dim=-2)
+    for layer in model.layers:
+        if isinstance(layer, EnsembleLinear):
+            x = torch.einsum("kio, ...ki -> ...ko", layer.weight, x) + layer.bias
+        else:
+            x = layer(x)
+    return x
+
+def benchmark(fn, num_repeats=20):
+    """ Average wall time of fn in seconds after one warm up call """
+    fn()
+    start = time.time()
+    for _ in range(num_repeats):
+        fn()
+    return (time.time() - start) / num_repeats
+
+def main(arglist):
+    torch.manual_seed(arglist.seed)
+    if arglist.num_threads > 0:
+        torch.set_num_threads(arglist.num_threads)
+    print(f"torch threads: {torch.get_num_threads()}")
+    
+    # dynamics rollout forward
+    ensemble_mlp = EnsembleMLP(17, 18, 7, 200, 2, "silu")
+    x = torch.randn(arglist.rollout_batch_size, 17)
+    with torch.no_grad():
+        assert torch.allclose(ensemble_mlp(x), reference_forward(ensemble_mlp, x), atol=1e-4)
+        t = benchmark(lambda: ensemble_mlp(x), arglist.num_repeats)
+        t_ref = benchmark(lambda: reference_forward(ensemble_mlp, x), arglist.num_repeats)
+    print(f"EnsembleMLP forward batch {arglist.rollout_batch_size}: {t*1000:.1f} ms, einsum reference: {t_ref*1000:.1f} ms")
+    
+    # critic forward backward
+    double_q = DoubleQNetwork(17, 6, 256, 2, "relu")
+    ensemble_q = EnsembleQNetwork(17, 6, 256, 2, "relu", ensemble_dim=2)
+    o, a = torch.randn(arglist.batch_size, 17), torch.randn(arglist.batch_size, 6)
+    def q_step(critic):
+        q = critic.compute_q(o, a)
+        torch.pow(q, 2).mean().backward()
+    t = benchmark(lambda: q_step(ensemble_q), 10 * arglist.num_repeats)
+    t_ref = benchmark(lambda: q_step(double_q), 10 * arglist.num_repeats)
+    print(f"EnsembleQNetwork forward backward batch {arglist.batch_size}: {t*1000:.2f} ms, DoubleQNetwork: {t_ref*1000:.2f} ms")
+
+if __name__ == "__main__":
+    arglist = parse_args()
+    main(arglist)
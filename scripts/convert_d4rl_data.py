@@ -0,0 +1,39 @@
+import argparse
+import os
+import pickle
+import numpy as np
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, default="../data")
+    parser.add_argument("--dataset_name", type=str, default="hopper-medium-expert-v2")
+    arglist = vars(parser.parse_args())
+    return arglist
+
+def main(arglist):
+    """ Convert pickled d4rl dataset to a directory of .npy files for MemmapReplayBuffer """
+    dataset_name = arglist["dataset_name"]
+    data_path = os.path.join(arglist["data_path"], "d4rl")
+    save_path = os.path.join(data_path, dataset_name)
+    if not os.path.exists(save_path):
+        os.mkdir(save_path)
+    
+    with open(os.path.join(data_path, f"{dataset_name}.p"), "rb") as f:
+        dataset = pickle.load(f)
+    
+    fields = {
+        "obs": dataset["observations"],
+        "act": dataset["actions"],
+        "rwd": dataset["rewards"].reshape(-1, 1),
+        "next_obs": dataset["next_observations"],
+        "done": dataset["terminals"].reshape(-1, 1),
+        "timeout": dataset["timeouts"].reshape(-1, 1),
+    }
+    for key, value in fields.items():
+        np.save(os.path.join(save_path, f"{key}.npy"), value.astype(np.float32))
+    
+    print("dataset saved at: {}".format(save_path))
+
+if __name__ == "__main__":
+    arglist = parse_args()
+    main(arglist)
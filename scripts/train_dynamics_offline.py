@@ -7,7 +7,7 @@ import pandas as pd
 import torch
 import torch.nn as nn
 
-from src.agents.dynamics import EnsembleDynamics, train_ensemble
+from src.agents.dynamics import EnsembleDynamics, FusedEnsembleDynamics, EnsembleHead, train_ensemble
 from src.algo.logging_utils import SaveCallback
 
 def parse_args():
@@ -31,6 +31,7 @@ def parse_args():
     parser.add_argument("--activation", type=str, default="relu", help="neural network activation, default=relu")
     parser.add_argument("--clip_lv", type=bool_, default=True, help="whether to clip observation variance, default=True")
     parser.add_argument("--residual", type=bool_, default=False, help="whether to predict observation residual, default=False")
+    parser.add_argument("--fused_model", type=bool_, default=False, help="whether to predict reward and dynamics with one network, default=False")
     # training args
     parser.add_argument("--batch_size", type=int, default=256, help="training batch size, default=256")
     parser.add_argument("--lr", type=float, default=0.001, help="learning rate, default=0.001")
@@ -39,6 +40,8 @@ def parse_args():
     parser.add_argument("--grad_clip", type=float, default=100., help="gradient clipping, default=100.")
     parser.add_argument("--epochs", type=int, default=100, help="number of reward training epochs, default=10")
     parser.add_argument("--max_epochs_since_update", type=int, default=10, help="early stopping condition, default=10")
+    parser.add_argument("--bootstrap", type=bool_, default=False, help="whether to train members on bootstrap resamples, default=False")
+    parser.add_argument("--eval_chunk_size", type=int, default=10000, help="number of eval samples evaluated at once, default=10000")
     parser.add_argument("--cp_every", type=int, default=10, help="checkpoint interval, default=10")
     parser.add_argument("--verbose", type=int, default=1, help="verbose interval, default=1")
     parser.add_argument("--save", type=bool_, default=True)
@@ -50,14 +53,23 @@ def parse_args():
 class DummyAgent(nn.Module):
     def __init__(self, reward, dynamics, device, lr=1e-3):
         super().__init__()
-        self.reward = reward
-        self.dynamics = dynamics
         self.device = device
-
-        self.optimizers = {
-            "reward": torch.optim.Adam(reward.parameters(), lr=lr),
-            "dynamics": torch.optim.Adam(dynamics.parameters(), lr=lr),
-        }
+        
+        if isinstance(dynamics, FusedEnsembleDynamics):
+            # reward and dynamics are views of the fused model
+            self.model = dynamics
+            self.reward = EnsembleHead(dynamics, dynamics.obs_dim, dynamics.obs_dim + 1)
+            self.dynamics = EnsembleHead(dynamics, 0, dynamics.obs_dim)
+            self.optimizers = {
+                "dynamics": torch.optim.Adam(dynamics.parameters(), lr=lr),
+            }
+        else:
+            self.reward = reward
+            self.dynamics = dynamics
+            self.optimizers = {
+                "reward": torch.optim.Adam(reward.parameters(), lr=lr),
+                "dynamics": torch.optim.Adam(dynamics.parameters(), lr=lr),
+            }
 
 def main(arglist):
     np.random.seed(arglist["seed"])
@@ -94,36 +106,53 @@ def main(arglist):
     # init model
     obs_dim = obs.shape[-1]
     act_dim = act.shape[-1]
-    reward = EnsembleDynamics(
-        obs_dim,
-        act_dim,
-        1,
-        arglist["ensemble_dim"],
-        arglist["topk"],
-        arglist["hidden_dim"],
-        arglist["num_hidden"],
-        arglist["activation"],
-        arglist["decay"],
-        clip_lv=arglist["clip_lv"],
-        residual=False,
-        termination_fn=None,
-        device=device
-    )
-    dynamics = EnsembleDynamics(
-        obs_dim,
-        act_dim,
-        obs_dim,
-        arglist["ensemble_dim"],
-        arglist["topk"],
-        arglist["hidden_dim"],
-        arglist["num_hidden"],
-        arglist["activation"],
-        arglist["decay"],
-        clip_lv=arglist["clip_lv"],
-        residual=arglist["residual"],
-        termination_fn=None,
-        device=device
-    )
+    if arglist["fused_model"]:
+        reward = None
+        dynamics = FusedEnsembleDynamics(
+            obs_dim,
+            act_dim,
+            arglist["ensemble_dim"],
+            arglist["topk"],
+            arglist["hidden_dim"],
+            arglist["num_hidden"],
+            arglist["activation"],
+            arglist["decay"],
+            clip_lv=arglist["clip_lv"],
+            residual=arglist["residual"],
+            termination_fn=None,
+            device=device
+        )
+    else:
+        reward = EnsembleDynamics(
+            obs_dim,
+            act_dim,
+            1,
+            arglist["ensemble_dim"],
+            arglist["topk"],
+            arglist["hidden_dim"],
+            arglist["num_hidden"],
+            arglist["activation"],
+            arglist["decay"],
+            clip_lv=arglist["clip_lv"],
+            residual=False,
+            termination_fn=None,
+            device=device
+        )
+        dynamics = EnsembleDynamics(
+            obs_dim,
+            act_dim,
+            obs_dim,
+            arglist["ensemble_dim"],
+            arglist["topk"],
+            arglist["hidden_dim"],
+            arglist["num_hidden"],
+            arglist["activation"],
+            arglist["decay"],
+            clip_lv=arglist["clip_lv"],
+            residual=arglist["residual"],
+            termination_fn=None,
+            device=device
+        )
     agent = DummyAgent(reward, dynamics, device)
     agent.to(device)
     print(agent)
@@ -166,7 +195,9 @@ def main(arglist):
         max_epoch_since_update=arglist["max_epochs_since_update"],
         verbose=arglist["verbose"], 
         callback=callback, 
-        debug=True
+        debug=True,
+        bootstrap=arglist["bootstrap"],
+        eval_chunk_size=arglist["eval_chunk_size"],
     )
 
     if arglist["save"]:
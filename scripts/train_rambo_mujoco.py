@@ -9,7 +9,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import torch 
 
-from src.agents.dynamics import EnsembleDynamics, train_ensemble
+from src.agents.dynamics import EnsembleDynamics, FusedEnsembleDynamics, train_ensemble, load_dynamics_state_dict
 from src.agents.rambo import RAMBO
 from src.env.gym_wrapper import GymEnv, get_termination_fn
 from src.algo.logging_utils import SaveCallback
@@ -42,6 +42,7 @@ def parse_args():
     parser.add_argument("--tune_beta", type=bool_, default=True, help="whether to tune beta, default=True")
     parser.add_argument("--clip_lv", type=bool_, default=True, help="whether to clip observation variance, default=True")
     parser.add_argument("--residual", type=bool_, default=False, help="whether to predict observation residual, default=False")
+    parser.add_argument("--fused_model", type=bool_, default=False, help="whether to predict reward and dynamics with one network, default=False")
     parser.add_argument("--rwd_clip_max", type=float, default=10., help="clip reward max value, default=10.")
     parser.add_argument("--obs_penalty", type=float, default=1., help="transition likelihood penalty, default=1.")
     parser.add_argument("--adv_penalty", type=float, default=3e-4, help="model advantage penalty, default=3e-4")
@@ -62,10 +63,18 @@ def parse_args():
     parser.add_argument("--a_steps", type=int, default=1, help="policy training steps per update, default=1")
     parser.add_argument("--lr_a", type=float, default=1e-4, help="actor learning rate, default=1e-4")
     parser.add_argument("--lr_c", type=float, default=3e-4, help="critic learning rate, default=3e-4")
+    parser.add_argument("--ensemble_critic", type=bool_, default=False, help="whether to use batched ensemble critic, not faster than two critics on cpu, default=False")
+    parser.add_argument("--num_critics", type=int, default=2, help="number of ensemble critics, default=2")
+    parser.add_argument("--num_min_critics", type=int, default=2, help="number of random ensemble critics to take min over in the target, the actor uses the mean over all critics if fewer than num_critics, default=2")
     parser.add_argument("--lr_m", type=float, default=3e-4, help="model learning rate, default=3e-4")
     parser.add_argument("--decay", type=list_, default=[0.000025, 0.00005, 0.000075, 0.0001], 
         help="weight decay for each layer, default=[0.000025, 0.00005, 0.000075, 0.0001]")
     parser.add_argument("--grad_clip", type=float, default=1000., help="gradient clipping, default=1000.")
+    parser.add_argument("--buffer_on_device", type=bool_, default=False, help="whether to store replay buffers on training device, default=False")
+    parser.add_argument("--prioritized_replay", type=bool_, default=False, help="whether to use prioritized replay buffer, default=False")
+    parser.add_argument("--masked_rollout", type=bool_, default=False, help="whether to rollout model with fixed batch shape, default=False")
+    parser.add_argument("--eval_chunk_size", type=int, default=10000, help="number of samples evaluated at once in model evaluation, default=10000")
+    parser.add_argument("--overlap_rollout", type=bool_, default=False, help="whether to rollout model in background during policy updates, rollouts lag one model generation, default=False")
     # rollout args
     parser.add_argument("--env_name", type=str, default="Hopper-v4", help="environment name, default=Hopper-v4")
     parser.add_argument("--pretrain_steps", type=int, default=50, help="number of dynamics and reward pretraining steps, default=50")
@@ -150,37 +159,55 @@ def main(arglist):
         obs_variance=obs_std**2
     )
 
-    reward = EnsembleDynamics(
-        obs_dim,
-        act_dim,
-        1,
-        arglist["ensemble_dim"],
-        arglist["topk"],
-        arglist["hidden_dim"],
-        arglist["num_hidden"],
-        arglist["activation"],
-        arglist["decay"],
-        clip_lv=arglist["clip_lv"],
-        residual=False,
-        termination_fn=None,
-        max_mu=arglist["rwd_clip_max"],
-        device=device
-    )
-    dynamics = EnsembleDynamics(
-        obs_dim,
-        act_dim,
-        obs_dim,
-        arglist["ensemble_dim"],
-        arglist["topk"],
-        arglist["hidden_dim"],
-        arglist["num_hidden"],
-        arglist["activation"],
-        arglist["decay"],
-        clip_lv=arglist["clip_lv"],
-        residual=arglist["residual"],
-        termination_fn=termination_fn,
-        device=device
-    )
+    if arglist["fused_model"]:
+        reward = None
+        dynamics = FusedEnsembleDynamics(
+            obs_dim,
+            act_dim,
+            arglist["ensemble_dim"],
+            arglist["topk"],
+            arglist["hidden_dim"],
+            arglist["num_hidden"],
+            arglist["activation"],
+            arglist["decay"],
+            clip_lv=arglist["clip_lv"],
+            residual=arglist["residual"],
+            termination_fn=termination_fn,
+            max_rwd_mu=arglist["rwd_clip_max"],
+            device=device
+        )
+    else:
+        reward = EnsembleDynamics(
+            obs_dim,
+            act_dim,
+            1,
+            arglist["ensemble_dim"],
+            arglist["topk"],
+            arglist["hidden_dim"],
+            arglist["num_hidden"],
+            arglist["activation"],
+            arglist["decay"],
+            clip_lv=arglist["clip_lv"],
+            residual=False,
+            termination_fn=None,
+            max_mu=arglist["rwd_clip_max"],
+            device=device
+        )
+        dynamics = EnsembleDynamics(
+            obs_dim,
+            act_dim,
+            obs_dim,
+            arglist["ensemble_dim"],
+            arglist["topk"],
+            arglist["hidden_dim"],
+            arglist["num_hidden"],
+            arglist["activation"],
+            arglist["decay"],
+            clip_lv=arglist["clip_lv"],
+            residual=arglist["residual"],
+            termination_fn=termination_fn,
+            device=device
+        )
     agent = RAMBO(
         reward,
         dynamics,
@@ -215,13 +242,21 @@ def main(arglist):
         lr_m=arglist["lr_m"], 
         grad_clip=arglist["grad_clip"], 
         device=device,
+        buffer_on_device=arglist["buffer_on_device"],
+        prioritized_replay=arglist["prioritized_replay"],
+        ensemble_critic=arglist["ensemble_critic"],
+        num_critics=arglist["num_critics"],
+        num_min_critics=arglist["num_min_critics"],
+        masked_rollout=arglist["masked_rollout"],
+        eval_chunk_size=arglist["eval_chunk_size"],
+        overlap_rollout=arglist["overlap_rollout"],
     )
     agent.to(device)
     plot_keys = agent.plot_keys
 
     if arglist["dynamics_path"] != "none":
         dynamics_state_dict = torch.load(os.path.join(arglist["dynamics_path"], "model.pt"), map_location=device)
-        agent.load_state_dict(dynamics_state_dict["model_state_dict"], strict=False)
+        load_dynamics_state_dict(agent, dynamics_state_dict["model_state_dict"])
         print(f"dynamics loaded from: {arglist['dynamics_path']}")
     
     agent.real_buffer.push_batch(
@@ -239,6 +274,7 @@ def main(arglist):
         cp_model_path.sort(key=lambda x: int(os.path.basename(x).replace(".pt", "").split("_")[-1]))
         
         state_dict = torch.load(cp_model_path[-1], map_location=device)
+        load_dynamics_state_dict(agent, state_dict["model_state_dict"])
         agent.load_state_dict(state_dict["model_state_dict"], strict=False)
         for optimizer_name, optimizer_state_dict in state_dict["optimizer_state_dict"].items():
             agent.optimizers[optimizer_name].load_state_dict(optimizer_state_dict)
@@ -280,6 +316,7 @@ def main(arglist):
         update_elites=True,
         max_epoch_since_update=10,
         verbose=1,
+        eval_chunk_size=arglist["eval_chunk_size"],
     )
     
     logger = agent.train_policy(
@@ -31,7 +31,12 @@ def parse_args():
     parser.add_argument("--steps", type=int, default=50, help="training steps per update, default=30")
     parser.add_argument("--lr_a", type=float, default=0.001, help="actor learning rate, default=0.001")
     parser.add_argument("--lr_c", type=float, default=0.001, help="critic learning rate, default=0.001")
+    parser.add_argument("--ensemble_critic", type=bool_, default=False, help="whether to use batched ensemble critic, not faster than two critics on cpu, default=False")
+    parser.add_argument("--num_critics", type=int, default=2, help="number of ensemble critics, default=2")
+    parser.add_argument("--num_min_critics", type=int, default=2, help="number of random ensemble critics to take min over in the target, the actor uses the mean over all critics if fewer than num_critics, default=2")
     parser.add_argument("--grad_clip", type=float, default=1000., help="gradient clipping, default=1000.")
+    parser.add_argument("--buffer_on_device", type=bool_, default=False, help="whether to store replay buffers on training device, default=False")
+    parser.add_argument("--prioritized_replay", type=bool_, default=False, help="whether to use prioritized replay buffer, default=False")
     # rollout args
     parser.add_argument("--env_name", type=str, default="Hopper-v4", help="environment name, default=Hopper-v4")
     parser.add_argument("--epochs", type=int, default=100, help="number of training epochs, default=10")
@@ -87,6 +92,11 @@ def main(arglist):
         lr_c=arglist["lr_c"], 
         grad_clip=arglist["grad_clip"], 
         device=device,
+        buffer_on_device=arglist["buffer_on_device"],
+        prioritized_replay=arglist["prioritized_replay"],
+        ensemble_critic=arglist["ensemble_critic"],
+        num_critics=arglist["num_critics"],
+        num_min_critics=arglist["num_min_critics"],
     )
     agent.to(device)
     plot_keys = agent.plot_keys
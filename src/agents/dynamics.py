@@ -5,7 +5,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.distributions as torch_dist
-from src.agents.nn_models import EnsembleMLP
+from src.agents.nn_models import EnsembleLinear, EnsembleMLP
 from src.agents.rl_utils import normalize, denormalize, Logger
 
 def soft_clamp(x, _min, _max):
@@ -46,7 +46,7 @@ class EnsembleDynamics(nn.Module):
             decay ([list, None], optional): weight decay for each dynamics and reward model layer. Default=None.
             clip_lv (bool, optional): whether to soft clip observation log variance. Default=False
             residual (bool, optional): whether to predict observation residuals. Default=False
-            termination_fn (func, optional): termination function to output rollout done. Default=None
+            termination_fn (func, optional): termination function on torch tensors to output rollout done. Default=None
             max_mu (float): maximum mean prediction. Default=1e5
             min_std (float): minimum standard deviation. Default=1e-5
             max_std (float): maximum standard deviation. Default=1e-5
@@ -92,18 +92,42 @@ class EnsembleDynamics(nn.Module):
         self.out_variance = nn.Parameter(torch.ones(out_dim), requires_grad=False)
     
     def update_stats(self, obs_mean, obs_variance, out_mean, out_variance):
-        self.obs_mean.data = torch.from_numpy(obs_mean).to(torch.float32).to(self.device)
-        self.obs_variance.data = torch.from_numpy(obs_variance).to(torch.float32).to(self.device)
-        self.out_mean.data = torch.from_numpy(out_mean).to(torch.float32).to(self.device)
-        self.out_variance.data = torch.from_numpy(out_variance).to(torch.float32).to(self.device)
+        """ Update normalization stats from np.array or torch.tensor """
+        self.obs_mean.data = torch.as_tensor(obs_mean, dtype=torch.float32, device=self.device)
+        self.obs_variance.data = torch.as_tensor(obs_variance, dtype=torch.float32, device=self.device)
+        self.out_mean.data = torch.as_tensor(out_mean, dtype=torch.float32, device=self.device)
+        self.out_variance.data = torch.as_tensor(out_variance, dtype=torch.float32, device=self.device)
 
-    def compute_dist(self, obs, act):
-        """ Compute normalized output distribution class """
+    def compute_dist(self, obs, act, member_inputs=False):
+        """ Compute normalized output distribution class 
+        
+        Args:
+            obs (torch.tensor): normalized observations. size=[..., obs_dim] or [..., ensemble_dim, obs_dim] if member_inputs
+            act (torch.tensor): actions. size=[..., act_dim] or [..., ensemble_dim, act_dim] if member_inputs
+            member_inputs (bool, optional): whether each member receives a separate input. Default=False
+        """
+        obs_act = torch.cat([obs, act], dim=-1)
+        if member_inputs:
+            return self.output_to_dist(obs, self.mlp.forward(obs_act, member_inputs=True))
+        return self.output_to_dist(obs.unsqueeze(-2), self.mlp.forward(obs_act))
+    
+    def compute_member_dist(self, obs, act, member_idx):
+        """ Compute normalized output distribution of a single member for each input 
+        
+        Args:
+            obs (torch.tensor): normalized observations. size=[batch_size, obs_dim]
+            act (torch.tensor): actions. size=[batch_size, act_dim]
+            member_idx (torch.tensor): member index of each input. size=[batch_size]
+        """
         obs_act = torch.cat([obs, act], dim=-1)
-        mu_, lv = torch.chunk(self.mlp.forward(obs_act), 2, dim=-1)
+        return self.output_to_dist(obs, self.mlp.forward_members(obs_act, member_idx))
+    
+    def output_to_dist(self, obs, out):
+        """ Convert mlp output to normalized output distribution """
+        mu_, lv = torch.chunk(out, 2, dim=-1)
         
         if self.residual:
-            mu = obs.unsqueeze(-2) + mu_
+            mu = obs + mu_
         else:
             mu = mu_
         mu = torch.clip(mu, -self.max_mu, self.max_mu)
@@ -114,18 +138,21 @@ class EnsembleDynamics(nn.Module):
             std = torch.exp(lv.clip(self.min_lv.data, self.max_lv.data))
         return torch_dist.Normal(mu, std)
     
-    def compute_log_prob(self, obs, act, target):
+    def compute_log_prob(self, obs, act, target, member_inputs=False):
         """ Compute ensemble log probability 
         
         Args:
             obs (torch.tensor): normalized observations. size=[..., obs_dim]
             act (torch.tensor): actions. size=[..., act_dim]
             target (torch.tensor): normalized targets. size=[..., out_dim]
+            member_inputs (bool, optional): whether inputs and targets have a member dimension before the last. Default=False
 
         Returns:
             out (torch.tensor): ensemble log probabilities of normalized targets. size=[..., ensemble_dim, 1]
         """
-        return self.compute_dist(obs, act).log_prob(target.unsqueeze(-2)).sum(-1, keepdim=True)
+        if not member_inputs:
+            target = target.unsqueeze(-2)
+        return self.compute_dist(obs, act, member_inputs).log_prob(target).sum(-1, keepdim=True)
     
     def compute_mixture_log_prob(self, obs, act, target):
         """ Compute log marginal probability 
@@ -153,14 +180,13 @@ class EnsembleDynamics(nn.Module):
         Returns:
             out (torch.tensor): normalized output sampled from ensemble member in topk_dist. size=[..., out_dim]
         """
-        out_dist = self.compute_dist(obs, act)
+        # randomly select from top models and only evaluate the selected member
+        ensemble_idx = torch_dist.Categorical(self.topk_dist).sample(obs.shape[:-1]).flatten()
+        out_dist = self.compute_member_dist(
+            obs.reshape(-1, self.obs_dim), act.reshape(-1, self.act_dim), ensemble_idx
+        )
         out = out_dist.rsample()
-        
-        # randomly select from top models
-        ensemble_idx = torch_dist.Categorical(self.topk_dist).sample(obs.shape[:-1]).unsqueeze(-1)
-        ensemble_idx_ = ensemble_idx.unsqueeze(-1).repeat_interleave(self.out_dim, dim=-1).to(self.device) # duplicate alone feature dim
-        out = torch.gather(out, -2, ensemble_idx_).squeeze(-2)
-        return out
+        return out.reshape(*obs.shape[:-1], self.out_dim)
     
     def step(self, obs, act):
         """ Simulate a step forward with normalization pre and post processing
@@ -176,19 +202,63 @@ class EnsembleDynamics(nn.Module):
         obs_norm = normalize(obs, self.obs_mean, self.obs_variance)
         out_norm = self.sample_dist(obs_norm, act)
         out = denormalize(out_norm, self.out_mean, self.out_variance)
+        done = self.compute_done(obs, act, out)
+        return out, done
+    
+    def sample_with_dist(self, obs, act):
+        """ Sample from ensemble and keep the ensemble distribution of the same forward pass 
+        
+        Args:
+            obs (torch.tensor): normalized observations. size=[..., obs_dim]
+            act (torch.tensor): normaized actions. size=[..., act_dim]
+
+        Returns:
+            out (torch.tensor): detached normalized output sampled from ensemble member in topk_dist. size=[..., out_dim]
+            out_dist (torch_dist.Normal): normalized ensemble distribution. size=[..., ensemble_dim, out_dim]
+        """
+        out_dist = self.compute_dist(obs, act)
+        ensemble_idx = torch_dist.Categorical(self.topk_dist).sample(obs.shape[:-1])
+        ensemble_idx = ensemble_idx.unsqueeze(-1).unsqueeze(-1).expand(*obs.shape[:-1], 1, self.out_dim)
+        with torch.no_grad():
+            mu = torch.gather(out_dist.loc, -2, ensemble_idx).squeeze(-2)
+            std = torch.gather(out_dist.scale, -2, ensemble_idx).squeeze(-2)
+            out = mu + std * torch.randn_like(mu)
+        return out, out_dist
+    
+    def step_with_log_prob(self, obs, act):
+        """ Simulate a step forward and compute log marginal probability of the sample from one forward pass
+        
+        Args:
+            obs (torch.tensor): unnormalized observations. size=[..., obs_dim]
+            act (torch.tensor): unnormaized actions. size=[..., act_dim]
 
+        Returns:
+            out (torch.tensor): detached sampled unnormalized outputs. size=[..., out_dim]
+            done (torch.tensor): done flag. If termination_fn is None, return all zeros. size=[..., 1]
+            mixture_log_prob (torch.tensor): log marginal probabilities of normalized samples. size=[..., 1]
+        """
+        obs_norm = normalize(obs, self.obs_mean, self.obs_variance)
+        out_norm, out_dist = self.sample_with_dist(obs_norm, act)
+        
+        log_elites = torch.log(self.topk_dist + 1e-6).unsqueeze(-1)
+        log_prob = out_dist.log_prob(out_norm.unsqueeze(-2)).sum(-1, keepdim=True)
+        mixture_log_prob = torch.logsumexp(log_prob + log_elites, dim=-2)
+        
+        out = denormalize(out_norm, self.out_mean, self.out_variance)
+        done = self.compute_done(obs, act, out)
+        return out, done, mixture_log_prob
+    
+    def compute_done(self, obs, act, out):
+        """ Compute done flag from unnormalized outputs. If termination_fn is None, return all zeros. size=[..., 1] """
         if self.termination_fn is not None:
-            done = self.termination_fn(
-                obs.data.cpu().numpy(), act.data.cpu().numpy(), out.data.cpu().numpy()
-            )
-            done = torch.from_numpy(done).unsqueeze(-1).to(torch.float32).to(self.device)
+            done = self.termination_fn(obs, act, out).unsqueeze(-1).to(torch.float32)
         else:
-            done = torch.zeros(list(obs.shape)[:-1] + [1]).to(torch.float32).to(self.device)
-        return out, done
+            done = torch.zeros(list(obs.shape)[:-1] + [1], device=obs.device)
+        return done
     
-    def compute_loss(self, obs, act, target):
+    def compute_loss(self, obs, act, target, member_inputs=False):
         """ Compute log likelihood for normalized data and weight decay loss """
-        logp = self.compute_log_prob(obs, act, target).sum(-1)
+        logp = self.compute_log_prob(obs, act, target, member_inputs).sum(-1)
         decay_loss = self.compute_decay_loss()
         loss = -logp.mean() + decay_loss
         return loss
@@ -201,19 +271,46 @@ class EnsembleDynamics(nn.Module):
                 i += 1
         return loss
     
-    def evaluate(self, obs, act, target):
-        """ Compute mean average error of normalized data for each ensemble 
+    def evaluate(self, obs, act, target, chunk_size=10000):
+        """ Compute per member mean average error, negative log likelihood, and calibration of normalized data. 
+        Evaluation is done in chunks without gradient tracking to bound peak memory 
         
+        Args:
+            obs (torch.tensor): normalized observations. size=[batch_size, obs_dim]
+            act (torch.tensor): actions. size=[batch_size, act_dim]
+            target (torch.tensor): normalized targets. size=[batch_size, out_dim]
+            chunk_size (int, optional): number of samples evaluated at once. Default=10000
+
         Returns:
-            stats (dict): MAE dict with fields [mae_0, ..., mae_{ensemble_dim}, mae]
+            stats (dict): eval dict with fields [mae_0, ..., mae_{ensemble_dim}, mae, nll_0, ..., nll_{ensemble_dim}, nll, 
+                z_sq, coverage]. z_sq is the mean squared standardized error (1 if calibrated) and coverage 
+                is the fraction of targets within one standard deviation (0.683 if calibrated)
         """
-        with torch.no_grad():
-            out_pred = self.compute_dist(obs, act).mean
+        abs_err = torch.zeros(self.ensemble_dim, device=obs.device)
+        nll = torch.zeros(self.ensemble_dim, device=obs.device)
+        z_sq = torch.zeros(self.ensemble_dim, device=obs.device)
+        coverage = torch.zeros(self.ensemble_dim, device=obs.device)
+        with torch.inference_mode():
+            for i in range(0, len(obs), chunk_size):
+                target_chunk = target[i:i+chunk_size].unsqueeze(-2)
+                out_dist = self.compute_dist(obs[i:i+chunk_size], act[i:i+chunk_size])
+                z = (target_chunk - out_dist.mean) / out_dist.stddev
+                
+                abs_err += torch.abs(out_dist.mean - target_chunk).sum((0, 2))
+                nll -= out_dist.log_prob(target_chunk).sum((0, 2))
+                z_sq += (z ** 2).sum((0, 2))
+                coverage += (torch.abs(z) < 1).sum((0, 2))
         
-        obs_mae = torch.abs(out_pred - target.unsqueeze(-2)).mean((0, 2))
+        num_samples = len(obs)
+        mae = (abs_err / (num_samples * self.out_dim)).cpu().tolist()
+        nll = (nll / num_samples).cpu().tolist()
         
-        stats = {f"mae_{i}": obs_mae[i].cpu().data.item() for i in range(self.ensemble_dim)}
-        stats["mae"] = obs_mae.mean().cpu().data.item()
+        stats = {f"mae_{i}": mae[i] for i in range(self.ensemble_dim)}
+        stats["mae"] = float(np.mean(mae))
+        stats.update({f"nll_{i}": nll[i] for i in range(self.ensemble_dim)})
+        stats["nll"] = float(np.mean(nll))
+        stats["z_sq"] = z_sq.sum().cpu().item() / (num_samples * self.ensemble_dim * self.out_dim)
+        stats["coverage"] = coverage.sum().cpu().item() / (num_samples * self.ensemble_dim * self.out_dim)
         return stats
     
     def update_topk_dist(self, stats):
@@ -225,30 +322,337 @@ class EnsembleDynamics(nn.Module):
         self.topk_dist.data = torch.from_numpy(topk_dist).to(torch.float32).to(self.device)
 
 
+class FusedEnsembleDynamics(EnsembleDynamics):
+    """ Joint reward and dynamics ensemble predicting [next_obs, rwd] from a single network """
+    def __init__(
+        self,
+        obs_dim,
+        act_dim,
+        ensemble_dim, 
+        topk,
+        hidden_dim, 
+        num_hidden, 
+        activation, 
+        decay=None, 
+        clip_lv=False, 
+        residual=False,
+        termination_fn=None, 
+        max_mu=1e5,
+        max_rwd_mu=1e5,
+        min_std=1e-5,
+        max_std=1.6,
+        device=torch.device("cpu")
+        ):
+        """
+        Args:
+            obs_dim (int): observation dimension
+            act_dim (int): action dimension
+            ensemble_dim (int): number of ensemble models
+            topk (int): top k models to perform rollout
+            hidden_dim (int): value network hidden dim
+            num_hidden (int): value network hidden layers
+            activation (str): value network activation
+            decay ([list, None], optional): weight decay for each layer. Default=None.
+            clip_lv (bool, optional): whether to soft clip output log variance. Default=False
+            residual (bool, optional): whether to predict observation residuals. Reward is predicted directly. Default=False
+            termination_fn (func, optional): termination function on torch tensors to output rollout done. Default=None
+            max_mu (float): maximum mean prediction. Default=1e5
+            max_rwd_mu (float): maximum reward mean prediction. Default=1e5
+            min_std (float): minimum standard deviation. Default=1e-5
+            max_std (float): maximum standard deviation. Default=1e-5
+            device (torch.device): computing device. default=cpu
+        """
+        super().__init__(
+            obs_dim, act_dim, obs_dim + 1, ensemble_dim, topk, hidden_dim, num_hidden, activation, 
+            decay=decay, clip_lv=clip_lv, residual=False, termination_fn=termination_fn, 
+            max_mu=max_mu, min_std=min_std, max_std=max_std, device=device
+        )
+        self.residual = residual
+        self.max_rwd_mu = max_rwd_mu
+    
+    def output_to_dist(self, obs, out):
+        """ Convert mlp output to normalized [next_obs, rwd] distribution with a separate reward mean clip """
+        if self.residual:
+            obs = torch.cat([obs, torch.zeros_like(obs[..., :1])], dim=-1)
+        dist = super().output_to_dist(obs, out)
+        mu = torch.cat([
+            dist.loc[..., :self.obs_dim], 
+            torch.clip(dist.loc[..., self.obs_dim:], -self.max_rwd_mu, self.max_rwd_mu)
+        ], dim=-1)
+        return torch_dist.Normal(mu, dist.scale)
+    
+    def compute_split_log_prob(self, obs, act, next_obs, rwd, member_inputs=False):
+        """ Compute ensemble log probability of next observation and reward from one forward pass 
+        
+        Args:
+            obs (torch.tensor): normalized observations. size=[..., obs_dim]
+            act (torch.tensor): actions. size=[..., act_dim]
+            next_obs (torch.tensor): normalized next observations. size=[..., obs_dim]
+            rwd (torch.tensor): normalized rewards. size=[..., 1]
+            member_inputs (bool, optional): whether inputs and targets have a member dimension before the last. Default=False
+
+        Returns:
+            logp_obs (torch.tensor): ensemble log probabilities of next observations. size=[..., ensemble_dim, 1]
+            logp_rwd (torch.tensor): ensemble log probabilities of rewards. size=[..., ensemble_dim, 1]
+        """
+        target = torch.cat([next_obs, rwd], dim=-1)
+        if not member_inputs:
+            target = target.unsqueeze(-2)
+        log_prob = self.compute_dist(obs, act, member_inputs).log_prob(target)
+        logp_obs = log_prob[..., :self.obs_dim].sum(-1, keepdim=True)
+        logp_rwd = log_prob[..., self.obs_dim:].sum(-1, keepdim=True)
+        return logp_obs, logp_rwd
+    
+    def compute_split_mixture_log_prob(self, obs, act, next_obs, rwd):
+        """ Compute log marginal probability of next observation and reward from one forward pass 
+        
+        Returns:
+            logp_obs (torch.tensor): log marginal probabilities of next observations. size=[..., 1]
+            logp_rwd (torch.tensor): log marginal probabilities of rewards. size=[..., 1]
+        """
+        log_elites = torch.log(self.topk_dist + 1e-6).unsqueeze(-1)
+        logp_obs, logp_rwd = self.compute_split_log_prob(obs, act, next_obs, rwd)
+        logp_obs = torch.logsumexp(logp_obs + log_elites, dim=-2)
+        logp_rwd = torch.logsumexp(logp_rwd + log_elites, dim=-2)
+        return logp_obs, logp_rwd
+    
+    def compute_split_loss(self, obs, act, next_obs, rwd, member_inputs=False):
+        """ Compute next observation and reward log likelihood losses. Weight decay is added to the observation loss """
+        logp_obs, logp_rwd = self.compute_split_log_prob(obs, act, next_obs, rwd, member_inputs)
+        obs_loss = -logp_obs.sum(-1).mean() + self.compute_decay_loss()
+        rwd_loss = -logp_rwd.sum(-1).mean()
+        return obs_loss, rwd_loss
+    
+    def step_with_split_log_prob(self, obs, act):
+        """ Simulate a step forward and compute log marginal probabilities of the sampled next observation 
+        and reward from one forward pass
+        
+        Args:
+            obs (torch.tensor): unnormalized observations. size=[..., obs_dim]
+            act (torch.tensor): unnormaized actions. size=[..., act_dim]
+
+        Returns:
+            out (torch.tensor): detached sampled unnormalized [next_obs, rwd]. size=[..., obs_dim + 1]
+            done (torch.tensor): done flag. If termination_fn is None, return all zeros. size=[..., 1]
+            logp_obs (torch.tensor): log marginal probabilities of normalized next observations. size=[..., 1]
+            logp_rwd (torch.tensor): log marginal probabilities of normalized rewards. size=[..., 1]
+        """
+        obs_norm = normalize(obs, self.obs_mean, self.obs_variance)
+        out_norm, out_dist = self.sample_with_dist(obs_norm, act)
+        
+        log_elites = torch.log(self.topk_dist + 1e-6).unsqueeze(-1)
+        log_prob = out_dist.log_prob(out_norm.unsqueeze(-2))
+        logp_obs = torch.logsumexp(log_prob[..., :self.obs_dim].sum(-1, keepdim=True) + log_elites, dim=-2)
+        logp_rwd = torch.logsumexp(log_prob[..., self.obs_dim:].sum(-1, keepdim=True) + log_elites, dim=-2)
+        
+        out = denormalize(out_norm, self.out_mean, self.out_variance)
+        done = self.compute_done(obs, act, out)
+        return out, done, logp_obs, logp_rwd
+    
+    def update_split_topk_dist(self, obs_stats, rwd_stats):
+        """ Update top k model selection distribution by the sum of next observation and reward errors of each member """
+        self.update_topk_dist({
+            f"mae_{i}": obs_stats[f"mae_{i}"] + rwd_stats[f"mae_{i}"] for i in range(self.ensemble_dim)
+        })
+    
+    def compute_done(self, obs, act, out):
+        """ Compute done flag from the next observation slice of unnormalized outputs """
+        return super().compute_done(obs, act, out[..., :self.obs_dim])
+
+
+class EnsembleHead:
+    """ Compatibility view of a slice of FusedEnsembleDynamics outputs with the EnsembleDynamics interface. 
+    The view holds no parameters so that only the fused model is saved in checkpoints 
+    """
+    def __init__(self, model, start, end):
+        """
+        Args:
+            model (FusedEnsembleDynamics): fused reward and dynamics model
+            start (int): first output index of the head
+            end (int): last output index of the head (exclusive)
+        """
+        self.model = model
+        self.start = start
+        self.end = end
+        self.out_dim = end - start
+    
+    @property
+    def obs_dim(self):
+        return self.model.obs_dim
+    
+    @property
+    def act_dim(self):
+        return self.model.act_dim
+    
+    @property
+    def ensemble_dim(self):
+        return self.model.ensemble_dim
+    
+    @property
+    def topk_dist(self):
+        return self.model.topk_dist
+    
+    @property
+    def obs_mean(self):
+        return self.model.obs_mean
+    
+    @property
+    def obs_variance(self):
+        return self.model.obs_variance
+    
+    @property
+    def out_mean(self):
+        return self.model.out_mean[self.start:self.end]
+    
+    @property
+    def out_variance(self):
+        return self.model.out_variance[self.start:self.end]
+    
+    def train(self, mode=True):
+        self.model.train(mode)
+        return self
+    
+    def eval(self):
+        return self.train(False)
+    
+    def update_stats(self, obs_mean, obs_variance, out_mean, out_variance):
+        """ Update observation stats and the head slice of output stats """
+        self.model.obs_mean.data = torch.as_tensor(obs_mean, dtype=torch.float32, device=self.model.device)
+        self.model.obs_variance.data = torch.as_tensor(obs_variance, dtype=torch.float32, device=self.model.device)
+        self.model.out_mean.data[self.start:self.end] = torch.as_tensor(out_mean, dtype=torch.float32)
+        self.model.out_variance.data[self.start:self.end] = torch.as_tensor(out_variance, dtype=torch.float32)
+    
+    def update_topk_dist(self, stats):
+        """ Update top k model selection distribution shared by all heads """
+        self.model.update_topk_dist(stats)
+    
+    def compute_dist(self, obs, act, member_inputs=False):
+        """ Compute normalized output distribution of the head """
+        out_dist = self.model.compute_dist(obs, act, member_inputs)
+        return torch_dist.Normal(out_dist.loc[..., self.start:self.end], out_dist.scale[..., self.start:self.end])
+    
+    compute_log_prob = EnsembleDynamics.compute_log_prob
+    compute_mixture_log_prob = EnsembleDynamics.compute_mixture_log_prob
+    evaluate = EnsembleDynamics.evaluate
+    
+    def step(self, obs, act):
+        """ Simulate a step forward and return the head slice of sampled outputs and done flag """
+        out, done = self.model.step(obs, act)
+        return out[..., self.start:self.end], done
+
+
+class EnsembleSnapshot:
+    def __init__(self, model, max_epoch_since_update=10, min_improvement=0.01):
+        """ Track the best eval error of each ensemble member and keep a copy of its weights 
+
+        Args:
+            model (EnsembleDynamics): ensemble model
+            max_epoch_since_update (int, optional): max epochs without improvement before a member is stalled. Default=10
+            min_improvement (float, optional): min relative error improvement to update a member. Default=0.01
+        """
+        self.model = model
+        self.max_epoch_since_update = max_epoch_since_update
+        self.min_improvement = min_improvement
+        
+        self.best_eval = 1e6 * np.ones(model.ensemble_dim)
+        self.epoch_since_update = np.zeros(model.ensemble_dim, dtype=np.int64)
+        self.params = [
+            p for layer in model.mlp.layers if isinstance(layer, EnsembleLinear) 
+            for p in [layer.weight, layer.bias]
+        ]
+        self.snapshot = [p.data.clone() for p in self.params]
+    
+    @property
+    def stalled(self):
+        """ Whether all members have not improved for more than max_epoch_since_update epochs """
+        return bool(np.all(self.epoch_since_update > self.max_epoch_since_update))
+
+    def update(self, maes):
+        """ Snapshot the weights of improved members 
+
+        Args:
+            maes (np.array): eval error of each member. size=[ensemble_dim]
+        """
+        maes = np.asarray(maes)
+        improvement = (self.best_eval - maes) / (self.best_eval + 1e-6)
+        improved = improvement > self.min_improvement
+        
+        self.best_eval[improved] = maes[improved]
+        self.epoch_since_update[improved] = 0
+        self.epoch_since_update[~improved] += 1
+        
+        idx = torch.from_numpy(np.flatnonzero(improved)).to(self.snapshot[0].device)
+        for p, p_snapshot in zip(self.params, self.snapshot):
+            p_snapshot[idx] = p.data[idx]
+    
+    def restore(self):
+        """ Load the best weights of every member """
+        for p, p_snapshot in zip(self.params, self.snapshot):
+            p.data.copy_(p_snapshot)
+        return {f"mae_{i}": v for i, v in enumerate(self.best_eval)}
+
+
+def load_dynamics_state_dict(agent, state_dict):
+    """ Load reward and dynamics parameters from an agent state dict. Separate models are loaded from 
+    reward.* and dynamics.* keys and a fused model is loaded from model.* keys
+    
+    Args:
+        agent (nn.Module): agent with reward and dynamics properties. If they are EnsembleHead views, 
+            the fused model is loaded from the model property
+        state_dict (dict): agent state dict
+    """
+    if isinstance(agent.dynamics, EnsembleHead):
+        modules = {"model": agent.model}
+    else:
+        modules = {"reward": agent.reward, "dynamics": agent.dynamics}
+    
+    for name, module in modules.items():
+        module_state_dict = {k[len(name) + 1:]: v for k, v in state_dict.items() if k.startswith(name + ".")}
+        if len(module_state_dict) == 0:
+            found = sorted(set([k.split(".")[0] for k in state_dict]))
+            raise ValueError(
+                f"state dict has no {name}.* parameters, found {found}. "
+                "Fused and separate reward and dynamics checkpoints are not interchangeable, "
+                "train the dynamics with the same fused_model setting"
+            )
+        module.load_state_dict(module_state_dict)
+
+
 def train_ensemble(
         data, agent, eval_ratio, batch_size, epochs, grad_clip=None, train_reward=True, 
         update_stats=True, update_elites=True, max_epoch_since_update=10, 
-        verbose=1, callback=None, debug=False
+        verbose=1, callback=None, debug=False, stats=None, bootstrap=False, eval_chunk_size=10000
     ):
     """
     Args:
         data (list): list of [obs, act, rwd, next_obs]
-        agent (nn.Module): agent with reward, dynamics, and optimizers properties
+        agent (nn.Module): agent with reward, dynamics, and optimizers properties. If reward and dynamics are 
+            EnsembleHead views, the fused model is trained with a single forward pass and optimizer
         eval_ratio (float): evaluation ratio
         epochs (int): max training epochs
         grad_clip (float): gradient norm clipping. Default=None
         train_reward (bool): whether to train reward. Default=True
         update_stats (bool): whether to normalize data and update reward and dynamics model stats. Default=True
         update_elites (bool): whether to update reward and dynamics topk_dist. Default=True
-        max_epoch_since_update (int): max epoch for termination condition. Default=10
+        max_epoch_since_update (int): max epoch without improvement of any member for termination condition. 
+            The best weights of each member are restored at the end. Default=10
         verbose (int): verbose interval. Default=1
         callback (object): callback object. Default=None
         debug (bool): debug flag. If True will print data stats. Default=None
+        stats (list, optional): precomputed [obs_mean, obs_variance, rwd_mean, rwd_variance] used instead of 
+            recomputing stats from training data when update_stats=True, e.g. streaming buffer stats. Default=None
+        bootstrap (bool, optional): whether to train each member on its own bootstrap resample of training data. Default=False
+        eval_chunk_size (int, optional): number of eval samples evaluated at once. Default=10000
 
     Returns:
         logger (Logger): logger class with training history
     """
     obs, act, rwd, next_obs = data
+    
+    # reward and dynamics heads of a fused model share parameters, optimizer, and elites
+    fused = isinstance(agent.dynamics, EnsembleHead)
+    if fused:
+        assert train_reward
 
     # train test split
     num_eval = int(len(obs) * eval_ratio)
@@ -265,11 +669,15 @@ def train_ensemble(
     # normalize data
     obs_mean, obs_var = 0., 1.
     rwd_mean, rwd_var = 0., 1.
-    if update_stats:
+    if update_stats and stats is not None:
+        obs_mean, obs_var, rwd_mean, rwd_var = stats
+    elif update_stats:
         obs_mean = obs_train.mean(0)
         obs_var = obs_train.var(0)
         rwd_mean = rwd_train.mean(0)
         rwd_var = rwd_train.var(0)
+    
+    if update_stats:
         agent.dynamics.update_stats(obs_mean, obs_var, obs_mean, obs_var)
         if train_reward:
             agent.reward.update_stats(obs_mean, obs_var, rwd_mean, rwd_var)
@@ -298,62 +706,94 @@ def train_ensemble(
         print("rwd_eval_mean", rwd_eval.mean(0).round(2))
         print("rwd_eval_std", rwd_eval.std(0).round(2))
     
-    # pack eval data
-    obs_eval = torch.from_numpy(obs_eval).to(torch.float32).to(agent.device)
-    act_eval = torch.from_numpy(act_eval).to(torch.float32).to(agent.device)
-    rwd_eval = torch.from_numpy(rwd_eval).to(torch.float32).to(agent.device)
-    next_obs_eval = torch.from_numpy(next_obs_eval).to(torch.float32).to(agent.device)
+    # pack train and eval data once as float32 device tensors
+    obs_train = torch.as_tensor(obs_train, dtype=torch.float32, device=agent.device)
+    act_train = torch.as_tensor(act_train, dtype=torch.float32, device=agent.device)
+    rwd_train = torch.as_tensor(rwd_train, dtype=torch.float32, device=agent.device)
+    next_obs_train = torch.as_tensor(next_obs_train, dtype=torch.float32, device=agent.device)
+    
+    obs_eval = torch.as_tensor(obs_eval, dtype=torch.float32, device=agent.device)
+    act_eval = torch.as_tensor(act_eval, dtype=torch.float32, device=agent.device)
+    rwd_eval = torch.as_tensor(rwd_eval, dtype=torch.float32, device=agent.device)
+    next_obs_eval = torch.as_tensor(next_obs_eval, dtype=torch.float32, device=agent.device)
+    
+    # per member bootstrap indices. size=[ensemble_dim, num_train]
+    if bootstrap:
+        ensemble_dim = agent.dynamics.ensemble_dim
+        if train_reward:
+            assert agent.reward.ensemble_dim == ensemble_dim
+        idx_bootstrap = torch.randint(len(obs_train), (ensemble_dim, len(obs_train)), device=agent.device)
+    
+    # per member early stopping. Fused members are tracked by the sum of next observation and reward errors
+    if fused:
+        snapshots = {"model": EnsembleSnapshot(agent.model, max_epoch_since_update)}
+    else:
+        snapshots = {"obs": EnsembleSnapshot(agent.dynamics, max_epoch_since_update)}
+        if train_reward:
+            snapshots["rwd"] = EnsembleSnapshot(agent.reward, max_epoch_since_update)
     
     logger = Logger()
     start_time = time.time()
-    best_eval = 1e6
-    epoch_since_last_update = 0
     for e in range(epochs):
         # shuffle train data
-        idx_train = np.arange(len(obs_train))
-        np.random.shuffle(idx_train)
+        if bootstrap:
+            idx_shuffle = torch.argsort(torch.rand(idx_bootstrap.shape, device=agent.device), dim=-1)
+            idx_train = torch.gather(idx_bootstrap, -1, idx_shuffle).T
+        else:
+            idx_train = torch.randperm(len(obs_train), device=agent.device)
 
         train_stats_epoch = []
         for i in range(0, obs_train.shape[0], batch_size):
-            idx_batch = idx_train[i:i+batch_size]
-            obs_batch = torch.from_numpy(obs_train[idx_batch]).to(torch.float32).to(agent.device)
-            act_batch = torch.from_numpy(act_train[idx_batch]).to(torch.float32).to(agent.device)
-            rwd_batch = torch.from_numpy(rwd_train[idx_batch]).to(torch.float32).to(agent.device)
-            next_obs_batch = torch.from_numpy(next_obs_train[idx_batch]).to(torch.float32).to(agent.device)
+            idx_batch = idx_train[i:i+batch_size] # size=[batch_size, ensemble_dim] if bootstrap
+            obs_batch = obs_train[idx_batch]
+            act_batch = act_train[idx_batch]
+            rwd_batch = rwd_train[idx_batch]
+            next_obs_batch = next_obs_train[idx_batch]
             
-            obs_loss = agent.dynamics.compute_loss(obs_batch, act_batch, next_obs_batch)
+            if fused:
+                obs_loss, rwd_loss = agent.model.compute_split_loss(
+                    obs_batch, act_batch, next_obs_batch, rwd_batch, member_inputs=bootstrap
+                )
+            else:
+                obs_loss = agent.dynamics.compute_loss(obs_batch, act_batch, next_obs_batch, member_inputs=bootstrap)
             total_loss = obs_loss
-            stats = {"obs_loss": obs_loss.cpu().data.item()}
+            train_stats = {"obs_loss": obs_loss.cpu().data.item()}
             if train_reward:
-                rwd_loss = agent.reward.compute_loss(obs_batch, act_batch, rwd_batch)
+                if not fused:
+                    rwd_loss = agent.reward.compute_loss(obs_batch, act_batch, rwd_batch, member_inputs=bootstrap)
                 total_loss += rwd_loss
-                stats["rwd_loss"] = rwd_loss.cpu().data.item()
+                train_stats["rwd_loss"] = rwd_loss.cpu().data.item()
 
             total_loss.backward()
             if grad_clip is not None:
                 nn.utils.clip_grad_norm_(agent.parameters(), grad_clip)
             agent.optimizers["dynamics"].step()
             agent.optimizers["dynamics"].zero_grad()
-            if train_reward:
+            if train_reward and not fused:
                 agent.optimizers["reward"].step()
                 agent.optimizers["reward"].zero_grad()
 
-            train_stats_epoch.append(stats)
-            logger.push(stats)
+            train_stats_epoch.append(train_stats)
+            logger.push(train_stats)
         train_stats_epoch = pd.DataFrame(train_stats_epoch).mean(0).to_dict()
         
         # evaluate
-        obs_eval_stats_epoch = agent.dynamics.evaluate(obs_eval, act_eval, next_obs_eval)
-        obs_eval_stats_epoch = {"obs_" + k: v for k, v in obs_eval_stats_epoch.items()}
-        eval_stats_epoch = obs_eval_stats_epoch
-        if update_elites:
+        obs_eval_stats_epoch = agent.dynamics.evaluate(obs_eval, act_eval, next_obs_eval, eval_chunk_size)
+        if update_elites and not fused:
             agent.dynamics.update_topk_dist(obs_eval_stats_epoch)
+        eval_stats_epoch = {"obs_" + k: v for k, v in obs_eval_stats_epoch.items()}
         if train_reward:
-            rwd_eval_stats_epoch = agent.reward.evaluate(obs_eval, act_eval, rwd_eval)
-            rwd_eval_stats_epoch = {"rwd_" + k: v for k, v in rwd_eval_stats_epoch.items()}
-            eval_stats_epoch = {**eval_stats_epoch, **rwd_eval_stats_epoch}
-            if update_elites:
+            rwd_eval_stats_epoch = agent.reward.evaluate(obs_eval, act_eval, rwd_eval, eval_chunk_size)
+            if update_elites and not fused:
                 agent.reward.update_topk_dist(rwd_eval_stats_epoch)
+            eval_stats_epoch.update({"rwd_" + k: v for k, v in rwd_eval_stats_epoch.items()})
+        if fused:
+            if update_elites:
+                agent.model.update_split_topk_dist(obs_eval_stats_epoch, rwd_eval_stats_epoch)
+            eval_stats_epoch.update({
+                f"model_mae_{i}": obs_eval_stats_epoch[f"mae_{i}"] + rwd_eval_stats_epoch[f"mae_{i}"]
+                for i in range(agent.model.ensemble_dim)
+            })
 
         # log stats
         stats_epoch = {**train_stats_epoch, **eval_stats_epoch}
@@ -365,6 +805,11 @@ def train_ensemble(
         if callback is not None:
             callback(agent, pd.DataFrame(logger.history))
         
+        # termination condition based on eval performance of each member
+        for key, snapshot in snapshots.items():
+            snapshot.update([stats_epoch[f"{key}_mae_{i}"] for i in range(snapshot.model.ensemble_dim)])
+        epoch_since_last_update = min([snapshot.epoch_since_update.min() for snapshot in snapshots.values()])
+        
         if (e + 1) % verbose == 0:
             print("e: {}, obs_loss: {:.4f}, obs_mae: {:.4f}, rwd_loss: {:.4f}, rwd_mae: {:.4f}, terminate: {}/{}".format(
                 e + 1, 
@@ -376,19 +821,23 @@ def train_ensemble(
                 max_epoch_since_update,
                 ))
         
-        # termination condition based on eval performance
-        current_eval = stats_epoch["obs_mae"]
-        if train_reward:
-            current_eval += stats_epoch["rwd_mae"]
-        improvement = (best_eval - current_eval) / (best_eval + 1e-6)
-        best_eval = min(best_eval, current_eval)
-        if improvement > 0.01:
-            epoch_since_last_update = 0
-        else:
-            epoch_since_last_update += 1
-         
-        if epoch_since_last_update > max_epoch_since_update:
+        if all([snapshot.stalled for snapshot in snapshots.values()]):
             break
+    
+    # restore best weights of each member and select elites by best eval error
+    if fused:
+        best_stats = snapshots["model"].restore()
+        if update_elites:
+            agent.model.update_topk_dist(best_stats)
+        return logger
+    
+    best_stats = snapshots["obs"].restore()
+    if update_elites:
+        agent.dynamics.update_topk_dist(best_stats)
+    if train_reward:
+        best_stats = snapshots["rwd"].restore()
+        if update_elites:
+            agent.reward.update_topk_dist(best_stats)
     return logger
 
 if __name__ == "__main__":
@@ -477,6 +926,19 @@ if __name__ == "__main__":
         if test_reward or termination_fn is None:
             assert done.sum() == 0
         
+        # test member dist matches ensemble dist
+        member_idx = torch.randint(ensemble_dim, (batch_size,))
+        member_dist = dynamics.compute_member_dist(obs, act, member_idx)
+        assert torch.allclose(member_dist.mean, out_dist.mean[torch.arange(batch_size), member_idx], atol=1e-5)
+        assert torch.allclose(member_dist.stddev, out_dist.stddev[torch.arange(batch_size), member_idx], atol=1e-5)
+        
+        # test single pass sample log likelihood matches separate mixture log likelihood of the sample
+        out_step, done, mix_logp_step = dynamics.step_with_log_prob(obs, act)
+        assert not out_step.requires_grad and mix_logp_step.requires_grad
+        out_step_norm = normalize(out_step, dynamics.out_mean, dynamics.out_variance)
+        mix_logp = dynamics.compute_mixture_log_prob(obs, act, out_step_norm)
+        assert torch.allclose(mix_logp_step, mix_logp, atol=1e-4)
+        
         # test backward
         loss = dynamics.compute_loss(obs, act, target)
         loss.backward()
@@ -487,6 +949,8 @@ if __name__ == "__main__":
         
         # test eval
         stats = dynamics.evaluate(obs, act, target)
+        stats_chunked = dynamics.evaluate(obs, act, target, chunk_size=300)
+        assert all([np.isclose(stats[k], stats_chunked[k], rtol=1e-4) for k in stats])
         dynamics.update_topk_dist(stats)
         assert sum(dynamics.topk_dist == 0) == (dynamics.ensemble_dim - dynamics.topk)
 
@@ -532,4 +996,44 @@ if __name__ == "__main__":
         test_reward=True
     )
 
-    print("reward passed")
\ No newline at end of file
+    print("reward passed")
+    # test fused reward and dynamics
+    def test_fused(residual=False):
+        fused = FusedEnsembleDynamics(
+            obs_dim, act_dim, ensemble_dim, topk, hidden_dim, num_hidden, activation, 
+            decay=decay, clip_lv=True, residual=residual, termination_fn=termination_fn, max_std=max_std
+        )
+        reward = EnsembleHead(fused, obs_dim, obs_dim + 1)
+        dynamics = EnsembleHead(fused, 0, obs_dim)
+        reward.update_stats(torch.zeros(obs_dim), torch.ones(obs_dim), torch.ones(1), 2 * torch.ones(1))
+        assert torch.all(fused.out_mean[obs_dim:] == 1) and torch.all(fused.out_mean[:obs_dim] == 0)
+        
+        next_obs = torch.randn(batch_size, obs_dim)
+        rwd = torch.randn(batch_size, 1)
+        out, done = fused.step(obs, act)
+        assert list(out.shape) == [batch_size, obs_dim + 1]
+        assert list(done.shape) == [batch_size, 1]
+        
+        logp_obs, logp_rwd = fused.compute_split_mixture_log_prob(obs, act, next_obs, rwd)
+        assert torch.allclose(logp_obs, dynamics.compute_mixture_log_prob(obs, act, next_obs), atol=1e-5)
+        assert torch.allclose(logp_rwd, reward.compute_mixture_log_prob(obs, act, rwd), atol=1e-5)
+        
+        out, done, logp_obs, logp_rwd = fused.step_with_split_log_prob(obs, act)
+        out_norm = normalize(out, fused.out_mean, fused.out_variance)
+        logp_obs_split, logp_rwd_split = fused.compute_split_mixture_log_prob(
+            obs, act, out_norm[..., :obs_dim], out_norm[..., obs_dim:]
+        )
+        assert torch.allclose(logp_obs, logp_obs_split, atol=1e-4)
+        assert torch.allclose(logp_rwd, logp_rwd_split, atol=1e-4)
+        
+        obs_loss, rwd_loss = fused.compute_split_loss(obs, act, next_obs, rwd)
+        loss = fused.compute_loss(obs, act, torch.cat([next_obs, rwd], dim=-1))
+        assert torch.isclose(obs_loss + rwd_loss, loss, atol=1e-4)
+        
+        stats = dynamics.evaluate(obs, act, next_obs)
+        dynamics.update_topk_dist(stats)
+        assert torch.all(reward.topk_dist == fused.topk_dist)
+    
+    test_fused(residual=True)
+    test_fused(residual=False)
+    print("fused passed")
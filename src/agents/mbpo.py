@@ -1,11 +1,16 @@
 import time
+import copy
 import numpy as np
 import pandas as pd
 import torch
+import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
 
 from src.agents.sac import SAC
-from src.agents.dynamics import train_ensemble
-from src.agents.rl_utils import ReplayBuffer, Logger
+from src.agents.dynamics import FusedEnsembleDynamics, EnsembleHead, EnsembleSnapshot, train_ensemble
+from src.agents.rl_utils import ReplayBuffer, TorchReplayBuffer, Logger
+from src.agents.rl_utils import SegmentedReplayBuffer, TorchSegmentedReplayBuffer
+from src.agents.rl_utils import normalize
 
 class MBPO(SAC):
     """ Model-based policy optimization """
@@ -40,12 +45,22 @@ class MBPO(SAC):
         lr_c=0.001, 
         lr_m=0.001, 
         grad_clip=None,
-        device=torch.device("cpu")
+        device=torch.device("cpu"),
+        buffer_on_device=False,
+        prioritized_replay=False,
+        masked_rollout=False,
+        eval_chunk_size=10000,
+        incremental_model_update=False,
+        overlap_rollout=False,
+        ensemble_critic=False,
+        num_critics=2,
+        num_min_critics=2,
         ):
         """
         Args:
-            reward (EnsembleDynamics): reward function as an EnsembleDynamics object
-            dynamics (EnsembleDynamics): transition function as an EnsembleDynamics object
+            reward (EnsembleDynamics): reward function as an EnsembleDynamics object. Ignored if dynamics is fused
+            dynamics (EnsembleDynamics): transition function as an EnsembleDynamics object 
+                or joint reward and transition function as a FusedEnsembleDynamics object
             obs_dim (int): observation dimension
             act_dim (int): action dimension
             act_lim (torch.tensor): action limits
@@ -74,11 +89,30 @@ class MBPO(SAC):
             lr_m (float, optional): model learning rate. Default=1e-3
             grad_clip (float, optional): gradient clipping. Default=None
             device (optional): training device. Default=cpu
+            buffer_on_device (bool, optional): whether to store replay buffers as tensors on device. Default=False
+            prioritized_replay (bool, optional): whether to sample model data proportional to td error. Default=False
+            masked_rollout (bool, optional): whether to rollout model with fixed batch shape and alive mask. 
+                Steps are written into [rollout_steps, batch_size] storage and pushed with one masked index, 
+                so peak rollout memory grows with rollout steps. Default=False
+            eval_chunk_size (int, optional): number of samples evaluated at once in model evaluation. Default=10000
+            incremental_model_update (bool, optional): whether to update model on a persistent train holdout split 
+                with compute proportional to new real transitions. Trades higher model error for cheaper updates. Default=False
+            overlap_rollout (bool, optional): whether to generate the next model rollout generation in a background thread 
+                while the policy trains on the current one. Each new buffer segment then holds rollouts of the previous 
+                model and actor, i.e. rollouts lag one generation behind. Default=False
+            ensemble_critic (bool, optional): whether to compute all critics in one batched ensemble network. 
+                This is not faster than two separate critics on CPU, see scripts/benchmark_nn_models.py. Default=False
+            num_critics (int, optional): number of ensemble critics. Only used if ensemble_critic=True. Default=2
+            num_min_critics (int, optional): size of the random critic subset to take the minimum over in the critic target. 
+                A new subset is drawn for every target. If num_min_critics < num_critics, the actor maximizes the mean 
+                over all critics as in REDQ, otherwise the minimum over all critics. Only used if ensemble_critic=True. Default=2
         """
         super().__init__(
             obs_dim, act_dim, act_lim, hidden_dim, num_hidden, activation, 
             gamma, beta, polyak, tune_beta, buffer_size, batch_size, a_steps, 
-            lr_a, lr_c, grad_clip, device
+            lr_a, lr_c, grad_clip, device, 
+            buffer_on_device=buffer_on_device, prioritized_replay=prioritized_replay, 
+            ensemble_critic=ensemble_critic, num_critics=num_critics, num_min_critics=num_min_critics
         )
         self.norm_obs = norm_obs
         self.rollout_batch_size = rollout_batch_size
@@ -90,19 +124,54 @@ class MBPO(SAC):
         self.real_ratio = real_ratio
         self.eval_ratio = eval_ratio
         self.m_steps = m_steps
+        self.masked_rollout = masked_rollout
+        self.eval_chunk_size = eval_chunk_size
+        self.incremental_model_update = incremental_model_update
+        self.overlap_rollout = overlap_rollout
         
-        self.reward = reward
-        self.dynamics = dynamics
-        
-        self.optimizers["reward"] = torch.optim.Adam(
-            self.reward.parameters(), lr=lr_m
-        )
-        self.optimizers["dynamics"] = torch.optim.Adam(
-            self.dynamics.parameters(), lr=lr_m, 
-        )
+        self.fused = isinstance(dynamics, FusedEnsembleDynamics)
+        if self.fused:
+            # reward and dynamics are views of the fused model
+            self.model = dynamics
+            self.reward = EnsembleHead(dynamics, obs_dim, obs_dim + 1)
+            self.dynamics = EnsembleHead(dynamics, 0, obs_dim)
+            
+            self.optimizers["dynamics"] = torch.optim.Adam(
+                self.model.parameters(), lr=lr_m, 
+            )
+        else:
+            self.reward = reward
+            self.dynamics = dynamics
+            
+            self.optimizers["reward"] = torch.optim.Adam(
+                self.reward.parameters(), lr=lr_m
+            )
+            self.optimizers["dynamics"] = torch.optim.Adam(
+                self.dynamics.parameters(), lr=lr_m, 
+            )
         
         # buffer to store environment data
-        self.real_buffer = ReplayBuffer(obs_dim, act_dim, buffer_size, momentum=0.)
+        if buffer_on_device:
+            self.real_buffer = TorchReplayBuffer(obs_dim, act_dim, buffer_size, momentum=0., device=device)
+        else:
+            self.real_buffer = ReplayBuffer(obs_dim, act_dim, buffer_size, momentum=0.)
+        
+        # model rollout buffer with one segment per rollout generation
+        if not prioritized_replay:
+            segment_size = rollout_batch_size * rollout_min_steps
+            if buffer_on_device:
+                self.replay_buffer = TorchSegmentedReplayBuffer(
+                    obs_dim, act_dim, model_retain_epochs, segment_size, momentum=0.99, device=device
+                )
+            else:
+                self.replay_buffer = SegmentedReplayBuffer(
+                    obs_dim, act_dim, model_retain_epochs, segment_size, momentum=0.99
+                )
+        
+        # persistent holdout assignment of each real buffer slot, grown with the buffer
+        if incremental_model_update:
+            self.holdout_mask = np.zeros(0, dtype=bool)
+            self.num_pushed_last_update = 0
 
         self.plot_keys = [
             "eval_eps_return_avg", "eval_eps_len_avg", "critic_loss_avg", 
@@ -118,15 +187,153 @@ class MBPO(SAC):
         self.dynamics.update_stats(obs_mean, obs_variance, obs_mean, obs_variance)
         self.reward.update_stats(obs_mean, obs_variance, rwd_mean, rwd_variance)
     
+    def normalize_model_data(self, data):
+        """ Move real data to device and normalize observations and rewards with model stats """
+        data = {k: v.to(self.device) for k, v in data.items()}
+        data["obs"] = normalize(data["obs"], self.dynamics.obs_mean, self.dynamics.obs_variance)
+        data["next_obs"] = normalize(data["next_obs"], self.dynamics.obs_mean, self.dynamics.obs_variance)
+        data["rwd"] = normalize(data["rwd"], self.reward.out_mean, self.reward.out_variance)
+        return data
+    
+    def compute_model_loss(self, batch):
+        """ Compute dynamics and reward log likelihood losses on a normalized batch """
+        if self.fused:
+            obs_loss, rwd_loss = self.model.compute_split_loss(
+                batch["obs"], batch["act"], batch["next_obs"], batch["rwd"]
+            )
+        else:
+            rwd_loss = self.reward.compute_loss(batch["obs"], batch["act"], batch["rwd"])
+            obs_loss = self.dynamics.compute_loss(batch["obs"], batch["act"], batch["next_obs"])
+        return obs_loss, rwd_loss
+    
+    def train_dynamics_incremental(self, epochs, update_stats, max_epochs_since_update=5, logger=None):
+        """ Train model for up to epochs passes over real transitions added since the last update. 
+        Minibatches are sampled from the persistent train split of the whole real buffer 
+        and normalized with streaming buffer stats. Members are early stopped and restored to their best weights 
+        on a holdout subsample proportional to new data. Because compute scales with new data rather than 
+        all data, model error is higher than full retraining at the same number of epochs
+        
+        Args:
+            epochs (int): max number of passes over new transitions
+            update_stats (bool): whether to update model stats from streaming buffer stats
+            max_epochs_since_update (int, optional): max epochs without improvement of any member. Default=5
+            logger (Logger, optional): logger. Default=None
+
+        Returns:
+            stats (dict): train and eval stats. Empty if either split has no data yet and training is skipped
+        """
+        # grow the persistent holdout assignment with the real buffer
+        num_unassigned = self.real_buffer.size - len(self.holdout_mask)
+        if num_unassigned > 0:
+            self.holdout_mask = np.concatenate([
+                self.holdout_mask, self.real_buffer.rng.random(num_unassigned) < self.eval_ratio
+            ])
+        
+        holdout_mask = self.holdout_mask[:self.real_buffer.size]
+        idx_train = np.where(~holdout_mask)[0]
+        idx_eval = np.where(holdout_mask)[0]
+        if len(idx_train) == 0 or len(idx_eval) == 0:
+            return {}
+        
+        if update_stats:
+            self.update_stats()
+        
+        num_new = min(self.real_buffer.num_pushed - self.num_pushed_last_update, self.real_buffer.size)
+        self.num_pushed_last_update = self.real_buffer.num_pushed
+        
+        if self.fused:
+            model_params = list(self.model.parameters())
+            model_optimizers = [self.optimizers["dynamics"]]
+            snapshots = {"model": EnsembleSnapshot(self.model, max_epochs_since_update)}
+        else:
+            model_params = list(self.reward.parameters()) + list(self.dynamics.parameters())
+            model_optimizers = [self.optimizers["reward"], self.optimizers["dynamics"]]
+            snapshots = {
+                "obs": EnsembleSnapshot(self.dynamics, max_epochs_since_update), 
+                "rwd": EnsembleSnapshot(self.reward, max_epochs_since_update),
+            }
+        
+        # holdout subsample sized by new data
+        num_eval = min(len(idx_eval), max(self.batch_size, int(self.eval_ratio * num_new)))
+        idx_eval = idx_eval[self.real_buffer.rng.choice(len(idx_eval), num_eval, replace=False)]
+        eval_data = self.normalize_model_data(self.real_buffer.get(idx_eval))
+        
+        train_stats_epoch = []
+        steps_per_epoch = int(np.ceil(num_new * (1 - self.eval_ratio) / self.batch_size))
+        for e in range(epochs):
+            self.reward.train()
+            self.dynamics.train()
+            for _ in range(steps_per_epoch):
+                idx_batch = idx_train[self.real_buffer.rng.integers(len(idx_train), size=self.batch_size)]
+                batch = self.normalize_model_data(self.real_buffer.get(idx_batch))
+                
+                obs_loss, rwd_loss = self.compute_model_loss(batch)
+                total_loss = obs_loss + rwd_loss
+                total_loss.backward()
+                if self.grad_clip is not None:
+                    nn.utils.clip_grad_norm_(model_params, self.grad_clip)
+                for optimizer in model_optimizers:
+                    optimizer.step()
+                    optimizer.zero_grad()
+                
+                train_stats_epoch.append({
+                    "obs_loss": obs_loss.cpu().data.item(), 
+                    "rwd_loss": rwd_loss.cpu().data.item(),
+                })
+            
+            self.reward.eval()
+            self.dynamics.eval()
+            reward_eval_stats = self.reward.evaluate(
+                eval_data["obs"], eval_data["act"], eval_data["rwd"], self.eval_chunk_size
+            )
+            dynamics_eval_stats = self.dynamics.evaluate(
+                eval_data["obs"], eval_data["act"], eval_data["next_obs"], self.eval_chunk_size
+            )
+            
+            # per member early stopping
+            ensemble_dim = self.dynamics.ensemble_dim
+            if self.fused:
+                snapshots["model"].update([
+                    dynamics_eval_stats[f"mae_{i}"] + reward_eval_stats[f"mae_{i}"] for i in range(ensemble_dim)
+                ])
+            else:
+                snapshots["obs"].update([dynamics_eval_stats[f"mae_{i}"] for i in range(ensemble_dim)])
+                snapshots["rwd"].update([reward_eval_stats[f"mae_{i}"] for i in range(ensemble_dim)])
+            if all([snapshot.stalled for snapshot in snapshots.values()]):
+                break
+        
+        # restore best weights of each member and select elites by best eval error
+        if self.fused:
+            self.model.update_topk_dist(snapshots["model"].restore())
+        else:
+            self.dynamics.update_topk_dist(snapshots["obs"].restore())
+            self.reward.update_topk_dist(snapshots["rwd"].restore())
+        
+        train_stats_epoch = pd.DataFrame(train_stats_epoch, columns=["obs_loss", "rwd_loss"]).mean(0).to_dict()
+        stats = {
+            "obs_loss": train_stats_epoch["obs_loss"],
+            "rwd_loss": train_stats_epoch["rwd_loss"],
+            "obs_mae": dynamics_eval_stats["mae"],
+            "rwd_mae": reward_eval_stats["mae"],
+            "obs_nll": dynamics_eval_stats["nll"],
+            "rwd_nll": reward_eval_stats["nll"],
+        }
+        if logger is not None:
+            logger.push(stats)
+        return stats
+    
     def train_dynamics_epoch(
         self, steps, update_stats, max_epochs_since_update=5, verbose=10, logger=None
         ):
+        if self.incremental_model_update:
+            return self.train_dynamics_incremental(steps, update_stats, max_epochs_since_update, logger=logger)
+        
         data = self.real_buffer.sample(self.real_buffer.size)
         data = [
-            data["obs"].numpy(),
-            data["act"].numpy(),
-            data["rwd"].numpy(),
-            data["next_obs"].numpy(),
+            data["obs"].cpu().numpy(),
+            data["act"].cpu().numpy(),
+            data["rwd"].cpu().numpy(),
+            data["next_obs"].cpu().numpy(),
         ]
         train_logger = train_ensemble(
             data, 
@@ -136,16 +343,27 @@ class MBPO(SAC):
             steps, 
             grad_clip=self.grad_clip, 
             update_stats=update_stats,
+            # normalize with streaming stats of the whole real buffer instead of recomputing train split stats. 
+            # Unlike before, the stats include the eval split and match those used by incremental updates
+            stats=[
+                torch.as_tensor(v).cpu().numpy() for v in [
+                    self.real_buffer.obs_mean, self.real_buffer.obs_variance, 
+                    self.real_buffer.rwd_mean, self.real_buffer.rwd_variance
+                ]
+            ],
             train_reward=True,
             update_elites=True,
             max_epoch_since_update=max_epochs_since_update,
             verbose=verbose, 
+            eval_chunk_size=self.eval_chunk_size,
         )
         stats = {
             "obs_loss": train_logger.history[-1]["obs_loss_avg"],
             "rwd_loss": train_logger.history[-1]["rwd_loss_avg"],
             "obs_mae": train_logger.history[-1]["obs_mae"],
             "rwd_mae": train_logger.history[-1]["rwd_mae"],
+            "obs_nll": train_logger.history[-1]["obs_nll"],
+            "rwd_nll": train_logger.history[-1]["rwd_nll"],
         }
         if logger is not None:
             logger.push(stats)
@@ -157,11 +375,15 @@ class MBPO(SAC):
             # mix real and fake data
             real_batch = self.real_buffer.sample(int(self.real_ratio * self.batch_size))
             fake_batch = self.replay_buffer.sample(int((1 - self.real_ratio) * self.batch_size))
-            batch = {
-                real_k: torch.cat([real_v, fake_v], dim=0) 
-                for ((real_k, real_v), (fake_k, fake_v)) 
-                in zip(real_batch.items(), fake_batch.items())
-            }
+            batch = {k: torch.cat([real_batch[k], fake_batch[k]], dim=0) for k in real_batch}
+            
+            # real samples get unit importance weight and are masked out of priority update
+            if "weight" in fake_batch:
+                batch["weight"] = torch.cat([torch.ones_like(real_batch["rwd"]), fake_batch["weight"]], dim=0)
+                batch["idx"] = fake_batch["idx"]
+                batch["priority_mask"] = torch.cat([
+                    torch.zeros(len(real_batch["rwd"]), dtype=torch.bool), fake_batch["priority_mask"]
+                ], dim=0)
             policy_stats = self.take_policy_gradient_step(batch, rwd_fn=rwd_fn)
             policy_stats_epoch.append(policy_stats)
 
@@ -171,16 +393,43 @@ class MBPO(SAC):
         policy_stats_epoch = pd.DataFrame(policy_stats_epoch).mean(0).to_dict()
         return policy_stats_epoch
     
-    def rollout_dynamics(self, obs, done, rollout_steps):
+    def push_model_data(self, obs, act, rwd, next_obs, done):
+        """ Push model rollout tensors to replay buffer, without host copy if the buffer is on device """
+        if not isinstance(self.replay_buffer, TorchReplayBuffer):
+            obs, act, rwd, next_obs, done = [x.cpu().numpy() for x in [obs, act, rwd, next_obs, done]]
+        self.replay_buffer.push_batch(obs, act, rwd, next_obs, done)
+
+    def step_model(self, obs, act):
+        """ Sample next observation, reward, and done flag from model. Fused models use a single forward pass
+        
+        Args:
+            obs (torch.tensor): observations. size=[batch_size, obs_dim]
+            act (torch.tensor): actions. size=[batch_size, act_dim]
+
+        Returns:
+            next_obs (torch.tensor): next observations. size=[batch_size, obs_dim]
+            rwd (torch.tensor): rewards. size=[batch_size, 1]
+            done (torch.tensor): done flag. size=[batch_size, 1]
+        """
+        if self.fused:
+            out, done = self.model.step(obs, act)
+            return out[..., :self.obs_dim], out[..., self.obs_dim:], done
+        
+        rwd, _ = self.reward.step(obs, act)
+        next_obs, done = self.dynamics.step(obs, act)
+        return next_obs, rwd, done
+    
+    def rollout_dynamics(self, obs, done, rollout_steps, stream=False):
         """ Rollout dynamics model
 
         Args:
             obs (torch.tensor): observations. size=[batch_size, obs_dim]
             done (torch.tensor): done flag. size=[batch_size, 1]
             rollout_steps (int): number of rollout steps.
+            stream (bool, optional): whether to push every step into replay buffer instead of returning data. Default=False
 
         Returns:
-            data (dict): size=[rollout_steps, batch_size, dim]
+            data (dict): size=[rollout_steps, batch_size, dim]. None if stream=True
         """
         self.reward.eval()
         self.dynamics.eval()
@@ -191,19 +440,24 @@ class MBPO(SAC):
         for t in range(rollout_steps):
             with torch.no_grad():
                 act = self.choose_action(obs)
-                rwd, _ = self.reward.step(obs, act)
-                next_obs, done = self.dynamics.step(obs, act)
+                next_obs, rwd, done = self.step_model(obs, act)
 
-            data["obs"].append(obs)
-            data["act"].append(act)
-            data["next_obs"].append(next_obs)
-            data["rwd"].append(rwd)
-            data["done"].append(done)
+            if stream:
+                self.push_model_data(obs, act, rwd, next_obs, done)
+            else:
+                data["obs"].append(obs)
+                data["act"].append(act)
+                data["next_obs"].append(next_obs)
+                data["rwd"].append(rwd)
+                data["done"].append(done)
             
             obs = next_obs[done.flatten() == 0].clone()            
             if len(obs) == 0:
                 break
         
+        if stream:
+            return
+        
         data["obs"] = torch.cat(data["obs"], dim=0)
         data["act"] = torch.cat(data["act"], dim=0)
         data["next_obs"] = torch.cat(data["next_obs"], dim=0)
@@ -211,6 +465,70 @@ class MBPO(SAC):
         data["done"] = torch.cat(data["done"], dim=0)
         return data
     
+    def rollout_dynamics_masked(self, obs, done, rollout_steps, stream=False):
+        """ Rollout dynamics model with fixed batch shape. Terminated rows are frozen and masked out
+
+        Args:
+            obs (torch.tensor): observations. size=[batch_size, obs_dim]
+            done (torch.tensor): done flag. size=[batch_size, 1]
+            rollout_steps (int): number of rollout steps.
+            stream (bool, optional): whether to push alive transitions into replay buffer with a single masked index 
+                after the rollout instead of returning data. Default=False
+
+        Returns:
+            data (dict): size=[rollout_steps, batch_size, dim] with field alive of size=[rollout_steps, batch_size]. 
+                Only alive transitions are valid. None if stream=True
+        """
+        self.reward.eval()
+        self.dynamics.eval()
+        
+        batch_size = len(obs)
+        data = {
+            "obs": torch.zeros(rollout_steps, batch_size, self.obs_dim, device=obs.device),
+            "act": torch.zeros(rollout_steps, batch_size, self.act_dim, device=obs.device),
+            "rwd": torch.zeros(rollout_steps, batch_size, 1, device=obs.device),
+            "next_obs": torch.zeros(rollout_steps, batch_size, self.obs_dim, device=obs.device),
+            "done": torch.zeros(rollout_steps, batch_size, 1, device=obs.device),
+            "alive": torch.zeros(rollout_steps, batch_size, dtype=torch.bool, device=obs.device),
+        }
+        
+        alive = torch.ones(batch_size, dtype=torch.bool, device=obs.device)
+        for t in range(rollout_steps):
+            with torch.no_grad():
+                act = self.choose_action(obs)
+                next_obs, rwd, done = self.step_model(obs, act)
+
+            data["obs"][t] = obs
+            data["act"][t] = act
+            data["rwd"][t] = rwd
+            data["next_obs"][t] = next_obs
+            data["done"][t] = done
+            data["alive"][t] = alive
+            
+            alive = alive & (done.flatten() == 0)
+            obs = torch.where(alive.unsqueeze(-1), next_obs, obs)
+            if not alive.any():
+                break
+        
+        if stream:
+            # steps after an early break keep alive=False and are dropped by the flush
+            alive = data.pop("alive")
+            self.push_model_data(*[data[k][alive] for k in ["obs", "act", "rwd", "next_obs", "done"]])
+            return None
+        return data
+    
+    def new_model_generation(self, rollout_steps):
+        """ Make room for a new generation of model rollouts and only keep the latest model_retain_epochs generations 
+        
+        Args:
+            rollout_steps (int): model rollout steps of the new generation
+        """
+        segment_size = int(min(self.buffer_size // self.model_retain_epochs, self.rollout_batch_size * rollout_steps))
+        if isinstance(self.replay_buffer, SegmentedReplayBuffer):
+            self.replay_buffer.new_segment(segment_size)
+        else:
+            self.replay_buffer.max_size = self.model_retain_epochs * segment_size
+    
     def sample_imagined_data(self, batch_size, rollout_steps, mix=True):
         """ Sample model rollout data and add to replay buffer
         
@@ -224,22 +542,81 @@ class MBPO(SAC):
         else:
             real_batch = self.real_buffer.sample(int(batch_size/2))
             fake_batch = self.replay_buffer.sample(int(batch_size/2))
-            batch = {
-                real_k: torch.cat([real_v, fake_v], dim=0) 
-                for ((real_k, real_v), (fake_k, fake_v)) 
-                in zip(real_batch.items(), fake_batch.items())
-            }
+            batch = {k: torch.cat([real_batch[k], fake_batch[k]], dim=0) for k in real_batch}
+        
+        # write every rollout step into replay buffer
+        if self.masked_rollout:
+            self.rollout_dynamics_masked(
+                batch["obs"].to(self.device), batch["done"].to(self.device), rollout_steps, stream=True
+            )
+        else:
+            self.rollout_dynamics(
+                batch["obs"].to(self.device), batch["done"].to(self.device), rollout_steps, stream=True
+            )
+    
+    def rollout_imagined_data(self, obs, done, rollout_steps):
+        """ Rollout model from initial states and return alive transitions without writing to replay buffer
+        
+        Args:
+            obs (torch.tensor): initial observations. size=[batch_size, obs_dim]
+            done (torch.tensor): initial done flag. size=[batch_size, 1]
+            rollout_steps (int): model rollout steps
+
+        Returns:
+            data (dict): size=[num_transitions, dim]
+        """
+        if self.masked_rollout:
+            data = self.rollout_dynamics_masked(obs, done, rollout_steps)
+            alive = data.pop("alive")
+            return {k: v[alive] for k, v in data.items()}
+        return self.rollout_dynamics(obs, done, rollout_steps)
+    
+    def copy_rollout_agent(self):
+        """ Copy the agent once for background rollouts. Buffers, critics, and optimizers are shared not copied """
+        shared = [self.real_buffer, self.replay_buffer, self.critic, self.critic_target, self.optimizers]
+        if self.incremental_model_update:
+            shared.append(self.holdout_mask)
+        memo = {id(x): x for x in shared}
+        return copy.deepcopy(self, memo)
+    
+    def sync_rollout_agent(self, rollout_agent):
+        """ Copy current actor and model weights into the rollout agent """
+        rollout_agent.actor.load_state_dict(self.actor.state_dict())
+        if self.fused:
+            rollout_agent.model.load_state_dict(self.model.state_dict())
+        else:
+            rollout_agent.reward.load_state_dict(self.reward.state_dict())
+            rollout_agent.dynamics.load_state_dict(self.dynamics.state_dict())
+    
+    def sample_imagined_data_async(self, executor, future, rollout_agent, batch_size, rollout_steps):
+        """ Push the pending background rollouts as a new generation and start the next rollouts 
+        with the current actor and model. Rollout synchronously if nothing is pending. 
+        Pushed rollouts were generated by the actor and model of the previous generation
         
-        rollout_data = self.rollout_dynamics(
+        Args:
+            executor (ThreadPoolExecutor): background rollout executor
+            future (Future): pending rollouts. None if nothing is pending
+            rollout_agent (MBPO): agent copy used for background rollouts
+            batch_size (int): rollout batch size
+            rollout_steps (int): model rollout steps
+
+        Returns:
+            future (Future): next pending rollouts
+        """
+        self.new_model_generation(rollout_steps)
+        if future is None:
+            self.sample_imagined_data(batch_size, rollout_steps, mix=False)
+        else:
+            data = future.result()
+            self.push_model_data(data["obs"], data["act"], data["rwd"], data["next_obs"], data["done"])
+        
+        # the rollout agent is idle once the pending rollouts are done
+        self.sync_rollout_agent(rollout_agent)
+        batch = self.real_buffer.sample(batch_size)
+        return executor.submit(
+            rollout_agent.rollout_imagined_data, 
             batch["obs"].to(self.device), batch["done"].to(self.device), rollout_steps
         )
-        self.replay_buffer.push_batch(
-            rollout_data["obs"].cpu().numpy(),
-            rollout_data["act"].cpu().numpy(),
-            rollout_data["rwd"].cpu().numpy(),
-            rollout_data["next_obs"].cpu().numpy(),
-            rollout_data["done"].cpu().numpy()
-        )
     
     def compute_rollout_steps(self, epoch):
         """ Linearly increate rollout steps based on epoch """
@@ -261,87 +638,103 @@ class MBPO(SAC):
         total_steps = epochs * steps_per_epoch + update_after
         start_time = time.time()
         
+        executor, rollout_agent, rollout_future = None, None, None
+        if self.overlap_rollout:
+            executor = ThreadPoolExecutor(max_workers=1)
+            rollout_agent = self.copy_rollout_agent()
+        
         epoch = 0
         obs, eps_return, eps_len = env.reset()[0], 0, 0
-        for t in range(total_steps):
-            if (t + 1) < update_after:
-                act = torch.rand(self.act_dim).uniform_(-1, 1) * self.act_lim.cpu()
-                act = act.data.numpy()
-            else:
-                with torch.no_grad():
-                    act = self.choose_action(
-                        torch.from_numpy(obs).view(1, -1).to(torch.float32).to(self.device)
-                    ).cpu().numpy().flatten()
-            next_obs, reward, terminated, truncated, info = env.step(act)
+        try:
+            for t in range(total_steps):
+                if (t + 1) < update_after:
+                    act = torch.rand(self.act_dim).uniform_(-1, 1) * self.act_lim.cpu()
+                    act = act.data.numpy()
+                else:
+                    with torch.no_grad():
+                        act = self.choose_action(
+                            torch.from_numpy(obs).view(1, -1).to(torch.float32).to(self.device)
+                        ).cpu().numpy().flatten()
+                next_obs, reward, terminated, truncated, info = env.step(act)
             
-            eps_return += reward
-            eps_len += 1
+                eps_return += reward
+                eps_len += 1
             
-            self.real_buffer.push(
-                obs, act, reward, next_obs, np.array(1. * terminated)
-            )
-            obs = next_obs
+                self.real_buffer.push(
+                    obs, act, reward, next_obs, np.array(1. * terminated)
+                )
+                obs = next_obs
             
-            # end of trajectory handeling
-            if terminated or (eps_len + 1) > max_steps:
-                self.real_buffer.push_batch()
-                logger.push({"eps_return": eps_return})
-                logger.push({"eps_len": eps_len})
+                # end of trajectory handeling
+                if terminated or (eps_len + 1) > max_steps:
+                    self.real_buffer.push_batch()
+                    logger.push({"eps_return": eps_return})
+                    logger.push({"eps_len": eps_len})
                 
-                # start new episode
-                obs, eps_return, eps_len = env.reset()[0], 0, 0
+                    # start new episode
+                    obs, eps_return, eps_len = env.reset()[0], 0, 0
 
-            # train model
-            if (t + 1) >= update_after and (t - update_after + 1) % update_model_every == 0:
-                model_stats_epoch = self.train_dynamics_epoch(
-                    self.m_steps, 
-                    update_stats=self.norm_obs,
-                    max_epochs_since_update=5, 
-                    verbose=self.m_steps + 1, 
-                    logger=logger
-                )
-                if verbose:
-                    round_loss_dict = {k: round(v, 3) for k, v in model_stats_epoch.items()}
-                    print(f"e: {epoch + 1}, t model: {t + 1}, {round_loss_dict}")
+                # train model
+                if (t + 1) >= update_after and (t - update_after + 1) % update_model_every == 0:
+                    model_stats_epoch = self.train_dynamics_epoch(
+                        self.m_steps, 
+                        update_stats=self.norm_obs,
+                        max_epochs_since_update=5, 
+                        verbose=self.m_steps + 1, 
+                        logger=logger
+                    )
+                    if verbose:
+                        round_loss_dict = {k: round(v, 3) for k, v in model_stats_epoch.items()}
+                        print(f"e: {epoch + 1}, t model: {t + 1}, {round_loss_dict}")
                 
-                # generate imagined data
-                rollout_steps = self.compute_rollout_steps(epoch + 1)
-                self.replay_buffer.max_size = min(
-                    self.buffer_size, int(self.model_retain_epochs * self.rollout_batch_size * rollout_steps)
-                )
-                self.sample_imagined_data(
-                    self.rollout_batch_size, rollout_steps, mix=False
-                )
-                print("rollout_steps: {}, real buffer size: {}, fake buffer size: {}".format(
-                    rollout_steps, self.real_buffer.size, self.replay_buffer.size
-                ))
+                    # generate imagined data
+                    rollout_steps = self.compute_rollout_steps(epoch + 1)
+                    if self.overlap_rollout:
+                        rollout_future = self.sample_imagined_data_async(
+                            executor, rollout_future, rollout_agent, self.rollout_batch_size, rollout_steps
+                        )
+                    else:
+                        self.new_model_generation(rollout_steps)
+                        self.sample_imagined_data(
+                            self.rollout_batch_size, rollout_steps, mix=False
+                        )
+                    print("rollout_steps: {}, real buffer size: {}, fake buffer size: {}".format(
+                        rollout_steps, self.real_buffer.size, self.replay_buffer.size
+                    ))
 
-            # train policy
-            if (t + 1) > update_after and (t - update_after + 1) % update_policy_every == 0:
-                policy_stats_epoch = self.train_policy_epoch(logger=logger)
-                if (t + 1) % verbose == 0:
-                    round_loss_dict = {k: round(v, 3) for k, v in policy_stats_epoch.items()}
-                    print(f"e: {epoch + 1}, t policy: {t + 1}, {round_loss_dict}")
+                # train policy
+                if (t + 1) > update_after and (t - update_after + 1) % update_policy_every == 0:
+                    policy_stats_epoch = self.train_policy_epoch(logger=logger)
+                    if (t + 1) % verbose == 0:
+                        round_loss_dict = {k: round(v, 3) for k, v in policy_stats_epoch.items()}
+                        print(f"e: {epoch + 1}, t policy: {t + 1}, {round_loss_dict}")
 
-            # end of epoch handeling
-            if (t + 1) > update_after and (t - update_after + 1) % steps_per_epoch == 0:
-                epoch = (t - update_after + 1) // steps_per_epoch
+                # end of epoch handeling
+                if (t + 1) > update_after and (t - update_after + 1) % steps_per_epoch == 0:
+                    epoch = (t - update_after + 1) // steps_per_epoch
 
-                # evaluate episodes
-                if num_eval_eps > 0:
-                    eval_eps = []
-                    for i in range(num_eval_eps):
-                        eval_eps.append(self.rollout(eval_env, max_steps, sample_mean=eval_deterministic))
-                        logger.push({"eval_eps_return": sum(eval_eps[-1]["rwd"])})
-                        logger.push({"eval_eps_len": sum(1 - eval_eps[-1]["done"])})
+                    # evaluate episodes
+                    if num_eval_eps > 0:
+                        eval_eps = []
+                        for i in range(num_eval_eps):
+                            eval_eps.append(self.rollout(eval_env, max_steps, sample_mean=eval_deterministic))
+                            logger.push({"eval_eps_return": sum(eval_eps[-1]["rwd"])})
+                            logger.push({"eval_eps_len": sum(1 - eval_eps[-1]["done"])})
 
-                logger.push({"epoch": epoch + 1})
-                logger.push({"time": time.time() - start_time})
-                logger.log()
-                print()
+                    logger.push({"epoch": epoch + 1})
+                    logger.push({"time": time.time() - start_time})
+                    logger.log()
+                    print()
 
-                if t > update_after and callback is not None:
-                    callback(self, pd.DataFrame(logger.history))
+                    if t > update_after and callback is not None:
+                        callback(self, pd.DataFrame(logger.history))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+        
+        # surface errors of the last pending rollouts which are not used
+        if rollout_future is not None and not rollout_future.cancelled():
+            rollout_future.result()
         
         env.close()
         return logger
\ No newline at end of file
@@ -16,8 +16,46 @@ class EnsembleLinear(nn.Module):
     
     def forward(self, x):
         """ Output size=[..., ensemble_dim, output_dim] """
-        out = torch.einsum("kio, ...ki -> ...ko", self.weight, x) + self.bias
-        return out
+        batch_shape = x.shape[:-2]
+        x = x.reshape(-1, self.ensemble_dim, self.input_dim).transpose(0, 1)
+        out = self.forward_ensemble(x).transpose(0, 1)
+        return out.reshape(*batch_shape, self.ensemble_dim, self.output_dim)
+    
+    def forward_ensemble(self, x):
+        """ Batched matmul in ensemble-major layout
+
+        Args:
+            x (torch.tensor): input. size=[ensemble_dim, batch_size, input_dim]
+
+        Returns:
+            out (torch.tensor): output. size=[ensemble_dim, batch_size, output_dim]
+        """
+        return torch.baddbmm(self.bias.unsqueeze(-2), x, self.weight)
+    
+    def forward_shared(self, x):
+        """ Batched matmul of an input shared by all members. The input is broadcast 
+        as a view and the weight is used in its stored layout so neither is copied
+
+        Args:
+            x (torch.tensor): input. size=[batch_size, input_dim]
+
+        Returns:
+            out (torch.tensor): output. size=[ensemble_dim, batch_size, output_dim]
+        """
+        x = x.unsqueeze(0).expand(self.ensemble_dim, -1, -1)
+        return torch.baddbmm(self.bias.unsqueeze(-2), x, self.weight)
+    
+    def forward_member(self, x, member):
+        """ Matmul with the weights of a single member
+
+        Args:
+            x (torch.tensor): input. size=[batch_size, input_dim]
+            member (int): member index
+
+        Returns:
+            out (torch.tensor): output. size=[batch_size, output_dim]
+        """
+        return torch.addmm(self.bias[member], x, self.weight[member])
 
 
 class MLP(nn.Module):
@@ -89,18 +127,59 @@ class EnsembleMLP(nn.Module):
         )
         return s
 
-    def forward(self, x):
+    def forward(self, x, member_inputs=False):
+        """ Share the input across members in the first layer and keep ensemble-major layout in hidden layers 
+        
+        Args:
+            x (torch.tensor): input batch. size=[batch_size, input_dim] or [batch_size, k, input_dim] if member_inputs
+            member_inputs (bool, optional): whether each member receives a separate input. Default=False
+
+        Outputs:
+            x (torch.tensor): output batch. size=[batch_size, k, output_dim]
         """
+        if member_inputs:
+            batch_shape = x.shape[:-2]
+            x = x.reshape(-1, self.ensemble_dim, self.input_dim).transpose(0, 1)
+            x = self.layers[0].forward_ensemble(x)
+        else:
+            batch_shape = x.shape[:-1]
+            x = self.layers[0].forward_shared(x.reshape(-1, self.input_dim))
+        for layer in self.layers[1:]:
+            if isinstance(layer, EnsembleLinear):
+                x = layer.forward_ensemble(x)
+            else:
+                x = layer(x)
+        x = x.transpose(0, 1)
+        return x.reshape(*batch_shape, self.ensemble_dim, self.output_dim)
+    
+    def forward_members(self, x, member_idx):
+        """ Evaluate each input with a single member by grouping rows that share the same member 
+        
         Args:
             x (torch.tensor): input batch. size=[batch_size, input_dim]
+            member_idx (torch.tensor): member index of each input. size=[batch_size]
 
         Outputs:
-            x (torch.tensor): output batch. size=[batch_size, k, output_dim]
+            out (torch.tensor): output batch. size=[batch_size, output_dim]
         """
-        x = x.unsqueeze(-2).repeat_interleave(self.ensemble_dim, dim=-2)
-        for layer in self.layers:
-            x = layer(x)
-        return x
+        order = torch.argsort(member_idx)
+        counts = torch.bincount(member_idx, minlength=self.ensemble_dim).tolist()
+        
+        out = []
+        for member, x_member in enumerate(torch.split(x[order], counts)):
+            if counts[member] == 0:
+                continue
+            for layer in self.layers:
+                if isinstance(layer, EnsembleLinear):
+                    x_member = layer.forward_member(x_member, member)
+                else:
+                    x_member = layer(x_member)
+            out.append(x_member)
+        
+        # restore input order
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(len(order), device=order.device)
+        return torch.cat(out, dim=0)[inverse]
 
 
 class DoubleQNetwork(nn.Module):
@@ -147,6 +226,125 @@ class DoubleQNetwork(nn.Module):
         q1 = self.q1(oa)
         q2 = self.q2(oa)
         return q1, q2
+    
+    def compute_q(self, o, a):
+        """ Compute stacked q values. size=[batch_size, 2, 1] """
+        return torch.stack(self.forward(o, a), dim=-2)
+    
+    def min_q(self, q):
+        """ Minimum of stacked q values. size=[batch_size, 1] """
+        return q.min(dim=-2)[0]
+    
+    def compute_min_q(self, o, a):
+        """ Compute min of q1 and q2. size=[batch_size, 1] """
+        return self.min_q(self.compute_q(o, a))
+    
+    def actor_q(self, q):
+        """ Actor objective of stacked q values, the min of q1 and q2. size=[batch_size, 1] """
+        return self.min_q(q)
+    
+    def compute_actor_q(self, o, a):
+        """ Compute actor objective, the min of q1 and q2. size=[batch_size, 1] """
+        return self.actor_q(self.compute_q(o, a))
+
+
+class EnsembleQNetwork(nn.Module):
+    """ Ensemble Q network for continuous actions with all members computed in one batched pass """
+    def __init__(self, obs_dim, act_dim, hidden_dim, num_hidden, activation="silu", ensemble_dim=2, num_min=2):
+        """
+        Args:
+            obs_dim (int): observation dimension
+            act_dim (int): action dimension
+            hidden_dim (int): value network hidden dim
+            num_hidden (int): value network hidden layers
+            activation (str, optional): value network activation. Default=silu
+            ensemble_dim (int, optional): number of q networks. Default=2
+            num_min (int, optional): size of the random subset to take the minimum over. Default=2
+        """
+        super().__init__()
+        assert ensemble_dim >= 2 and 1 <= num_min <= ensemble_dim
+        self.obs_dim = obs_dim
+        self.act_dim = act_dim
+        self.ensemble_dim = ensemble_dim
+        self.num_min = num_min
+
+        self.q = EnsembleMLP(
+            input_dim=obs_dim + act_dim,
+            output_dim=1,
+            ensemble_dim=ensemble_dim,
+            hidden_dim=hidden_dim,
+            num_hidden=num_hidden,
+            activation=activation,
+        )
+    
+    def __repr__(self):
+        s = "{}(input_dim={}, ensemble_dim={}, num_min={}, hidden_dim={}, num_hidden={}, activation={})".format(
+            self.__class__.__name__, self.obs_dim + self.act_dim, self.ensemble_dim, self.num_min, 
+            self.q.hidden_dim, self.q.num_hidden, self.q.activation
+        )
+        return s
+    
+    def forward(self, o, a):
+        """ Compute q values of the first two members for compatibility with DoubleQNetwork
+        
+        Args:
+            o (torch.tensor): observation. size=[batch_size, obs_dim]
+            a (torch.tensor): action. size=[batch_size, act_dim]
+
+        Returns:
+            q1 (torch.tensor): q1 value. size=[batch_size, 1]
+            q2 (torch.tensor): q2 value. size=[batch_size, 1]
+        """
+        q = self.compute_q(o, a)
+        return q[..., 0, :], q[..., 1, :]
+    
+    def compute_q(self, o, a):
+        """ Compute q values of all members
+        
+        Args:
+            o (torch.tensor): observation. size=[batch_size, obs_dim]
+            a (torch.tensor): action. size=[batch_size, act_dim]
+
+        Returns:
+            q (torch.tensor): q values. size=[batch_size, ensemble_dim, 1]
+        """
+        return self.q(torch.cat([o, a], dim=-1))
+    
+    def min_q(self, q):
+        """ Minimum over a random subset of num_min members shared by the batch
+
+        Args:
+            q (torch.tensor): q values. size=[batch_size, ensemble_dim, 1]
+
+        Returns:
+            q_min (torch.tensor): minimum q value. size=[batch_size, 1]
+        """
+        if self.num_min < self.ensemble_dim:
+            idx = torch.randperm(self.ensemble_dim, device=q.device)[:self.num_min]
+            q = q[..., idx, :]
+        return q.min(dim=-2)[0]
+    
+    def compute_min_q(self, o, a):
+        """ Compute minimum q value over a random subset of num_min members. size=[batch_size, 1] """
+        return self.min_q(self.compute_q(o, a))
+    
+    def actor_q(self, q):
+        """ Actor objective following REDQ. The mean over all members if num_min < ensemble_dim 
+        so the actor does not follow the random subset drawn for the target, else the minimum over all members
+
+        Args:
+            q (torch.tensor): q values. size=[batch_size, ensemble_dim, 1]
+
+        Returns:
+            q_actor (torch.tensor): actor q value. size=[batch_size, 1]
+        """
+        if self.num_min < self.ensemble_dim:
+            return q.mean(dim=-2)
+        return q.min(dim=-2)[0]
+    
+    def compute_actor_q(self, o, a):
+        """ Compute actor objective over all members. size=[batch_size, 1] """
+        return self.actor_q(self.compute_q(o, a))
 
 if __name__ == "__main__":
     torch.manual_seed(0)
@@ -163,6 +361,7 @@ if __name__ == "__main__":
     ensemble_lin = EnsembleLinear(input_dim, output_dim, ensemble_dim)
     out = ensemble_lin(x.unsqueeze(-2).repeat_interleave(ensemble_dim, dim=-2))
     assert list(out.shape) == [batch_size, ensemble_dim, output_dim]
+    assert torch.allclose(ensemble_lin.forward_shared(x).transpose(0, 1), out, atol=1e-5)
     print("EnsembleLinear passed")
     
     # test ensemble mlp
@@ -175,6 +374,51 @@ if __name__ == "__main__":
     )
     out = ensemble_mlp(x)
     assert list(out.shape) == [batch_size, ensemble_dim, output_dim]
+    assert list(ensemble_mlp(x.view(4, 8, input_dim)).shape) == [4, 8, ensemble_dim, output_dim]
+    
+    x_members = x.unsqueeze(-2).repeat_interleave(ensemble_dim, dim=-2)
+    assert torch.allclose(ensemble_mlp(x_members, member_inputs=True), ensemble_mlp(x), atol=1e-5)
+    
+    member_idx = torch.randint(ensemble_dim, (batch_size,))
+    out = ensemble_mlp.forward_members(x, member_idx)
+    out_ref = ensemble_mlp(x)[torch.arange(batch_size), member_idx]
+    assert torch.allclose(out, out_ref, atol=1e-5)
     print("EnsembleMLP passed")
 
-    
\ No newline at end of file
+    # test ensemble q network
+    obs_dim, act_dim = 11, 3
+    o, a = torch.randn(batch_size, obs_dim), torch.randn(batch_size, act_dim)
+    double_q = DoubleQNetwork(obs_dim, act_dim, hidden_dim, num_hidden, activation)
+    assert list(double_q.compute_q(o, a).shape) == [batch_size, 2, 1]
+    assert torch.allclose(double_q.compute_min_q(o, a), torch.min(*double_q(o, a)))
+    assert torch.allclose(double_q.compute_actor_q(o, a), torch.min(*double_q(o, a)))
+
+    ensemble_q = EnsembleQNetwork(obs_dim, act_dim, hidden_dim, num_hidden, activation, ensemble_dim=2)
+    q1, q2 = ensemble_q(o, a)
+    assert list(q1.shape) == [batch_size, 1] and list(q2.shape) == [batch_size, 1]
+    assert torch.allclose(ensemble_q.compute_min_q(o, a), torch.min(q1, q2))
+    assert torch.allclose(ensemble_q.compute_actor_q(o, a), torch.min(q1, q2))
+    
+    ensemble_q = EnsembleQNetwork(obs_dim, act_dim, hidden_dim, num_hidden, activation, ensemble_dim=10, num_min=2)
+    q = ensemble_q.compute_q(o, a)
+    assert list(q.shape) == [batch_size, 10, 1]
+    q_min = ensemble_q.min_q(q)
+    assert list(q_min.shape) == [batch_size, 1]
+    assert torch.all(q_min >= q.min(dim=-2)[0]) and torch.all(q_min <= q.max(dim=-2)[0])
+    assert torch.allclose(ensemble_q.actor_q(q), q.mean(dim=-2))
+    print("EnsembleQNetwork passed")
+
+    # compare against repeated input einsum reference
+    def reference_forward(model, x):
+        x = x.unsqueeze(-2).repeat_interleave(model.ensemble_dim, dim=-2)
+        for layer in model.layers:
+            if isinstance(layer, EnsembleLinear):
+                x = torch.einsum("kio, ...ki -> ...ko", layer.weight, x) + layer.bias
+            else:
+                x = layer(x)
+        return x
+    
+    x = torch.randn(batch_size, input_dim)
+    with torch.no_grad():
+        assert torch.allclose(ensemble_mlp(x), reference_forward(ensemble_mlp, x), atol=1e-5)
+    print("EnsembleMLP einsum reference passed")
@@ -3,6 +3,7 @@ import numpy as np
 import pandas as pd
 import torch
 import torch.nn as nn
+from concurrent.futures import ThreadPoolExecutor
 
 from src.agents.mbpo import MBPO
 from src.agents.rl_utils import Logger
@@ -44,12 +45,21 @@ class RAMBO(MBPO):
         lr_c=3e-4, 
         lr_m=3e-4, 
         grad_clip=None,
-        device=torch.device("cpu")
+        device=torch.device("cpu"),
+        buffer_on_device=False,
+        prioritized_replay=False,
+        masked_rollout=False,
+        eval_chunk_size=10000,
+        overlap_rollout=False,
+        ensemble_critic=False,
+        num_critics=2,
+        num_min_critics=2,
         ):
         """
         Args:
-            reward (EnsembleDynamics): reward function as an EnsembleDynamics object
-            dynamics (EnsembleDynamics): transition function as an EnsembleDynamics object
+            reward (EnsembleDynamics): reward function as an EnsembleDynamics object. Ignored if dynamics is fused
+            dynamics (EnsembleDynamics): transition function as an EnsembleDynamics object 
+                or joint reward and transition function as a FusedEnsembleDynamics object
             obs_dim (int): observation dimension
             act_dim (int): action dimension
             act_lim (torch.tensor): action limits
@@ -81,13 +91,31 @@ class RAMBO(MBPO):
             lr_m (float, optional): model learning rate. Default=3e-4
             grad_clip (float, optional): gradient clipping. Default=None
             device (optional): training device. Default=cpu
+            buffer_on_device (bool, optional): whether to store replay buffers as tensors on device. Default=False
+            prioritized_replay (bool, optional): whether to sample model data proportional to td error. Default=False
+            masked_rollout (bool, optional): whether to rollout model with fixed batch shape and alive mask. 
+                Steps are written into [rollout_steps, batch_size] storage and pushed with one masked index, 
+                so peak rollout memory grows with rollout steps. Default=False
+            eval_chunk_size (int, optional): number of samples evaluated at once in model evaluation. Default=10000
+            overlap_rollout (bool, optional): whether to generate the next model rollout generation in a background thread 
+                while the policy trains on the current one. Each new buffer segment then holds rollouts of the previous 
+                model and actor, i.e. rollouts lag one generation behind. Default=False
+            ensemble_critic (bool, optional): whether to compute all critics in one batched ensemble network. 
+                This is not faster than two separate critics on CPU, see scripts/benchmark_nn_models.py. Default=False
+            num_critics (int, optional): number of ensemble critics. Only used if ensemble_critic=True. Default=2
+            num_min_critics (int, optional): size of the random critic subset to take the minimum over in the critic target. 
+                A new subset is drawn for every target. If num_min_critics < num_critics, the actor maximizes the mean 
+                over all critics as in REDQ, otherwise the minimum over all critics. Only used if ensemble_critic=True. Default=2
         """
         super().__init__(
             reward, dynamics, obs_dim, act_dim, act_lim, hidden_dim, num_hidden, activation, 
             gamma, beta, polyak, tune_beta, False, buffer_size, batch_size, 
             rollout_batch_size, rollout_min_steps, rollout_max_steps, 
             rollout_min_epoch, rollout_max_epoch, model_retain_epochs,
-            real_ratio, eval_ratio, m_steps, a_steps, lr_a, lr_c, lr_m, grad_clip, device
+            real_ratio, eval_ratio, m_steps, a_steps, lr_a, lr_c, lr_m, grad_clip, device, 
+            buffer_on_device=buffer_on_device, prioritized_replay=prioritized_replay, 
+            masked_rollout=masked_rollout, eval_chunk_size=eval_chunk_size, overlap_rollout=overlap_rollout, 
+            ensemble_critic=ensemble_critic, num_critics=num_critics, num_min_critics=num_min_critics
         )
         self.obs_penalty = obs_penalty
         self.adv_penalty = adv_penalty
@@ -99,21 +127,20 @@ class RAMBO(MBPO):
         ]
     
     def compute_dynamics_adversarial_loss(self, obs, act):
-        # sample next obs and rwd
-        with torch.no_grad():
-            rwd, _ = self.reward.step(obs, act)
-            next_obs, done = self.dynamics.step(obs, act)
-            rwd_norm = normalize(rwd, self.reward.out_mean, self.reward.out_variance)
-            obs_norm = normalize(obs, self.dynamics.out_mean, self.dynamics.out_variance)
-            next_obs_norm = normalize(next_obs, self.dynamics.out_mean, self.dynamics.out_variance)
+        # sample next obs and rwd with ensemble mixture log likelihood from the same forward pass
+        if self.fused:
+            out, done, logp_obs, logp_rwd = self.model.step_with_split_log_prob(obs, act)
+            next_obs, rwd = out[..., :self.obs_dim], out[..., self.obs_dim:]
+        else:
+            rwd, _, logp_rwd = self.reward.step_with_log_prob(obs, act)
+            next_obs, done, logp_obs = self.dynamics.step_with_log_prob(obs, act)
         
         # compute advantage
-        q_1, q_2 = self.critic(obs, act)
-        q = torch.min(q_1, q_2)
+        q_ensemble = self.critic.compute_q(obs, act)
+        q = self.critic.actor_q(q_ensemble)
         with torch.no_grad():
             next_act, logp = self.sample_action(next_obs)
-            q_next_1, q_next_2 = self.critic(next_obs, next_act)
-            q_next = torch.min(q_next_1, q_next_2)
+            q_next = self.critic.compute_actor_q(next_obs, next_act)
             v_next = q_next - self.beta * logp
             advantage = rwd + (1 - done) * self.gamma * v_next - q.data
             
@@ -122,21 +149,15 @@ class RAMBO(MBPO):
             else:
                 advantage_norm = advantage
         
-        # compute ensemble mixture log likelihood
-        logp_rwd = self.reward.compute_mixture_log_prob(obs_norm, act, rwd_norm)
-        logp_obs = self.dynamics.compute_mixture_log_prob(obs_norm, act, next_obs_norm)
         adv_loss = torch.mean(advantage_norm * (logp_rwd + logp_obs))
 
         # update model aware q loss
         with torch.no_grad():
-            q_target_next_1, q_target_next_2 = self.critic_target(next_obs, next_act)
-            q_target_next = torch.min(q_target_next_1, q_target_next_2)
+            q_target_next = self.critic_target.compute_min_q(next_obs, next_act)
             v_target_next = q_target_next - self.beta * logp
             q_target = rwd + (1 - done) * self.gamma * v_target_next
 
-        q1_loss = torch.pow(q_1 - q_target, 2).mean()
-        q2_loss = torch.pow(q_2 - q_target, 2).mean()
-        adv_q_loss = (q1_loss + q2_loss) / 2 
+        adv_q_loss = torch.pow(q_ensemble - q_target.unsqueeze(-2), 2).mean()
 
         stats = {
             "v_next_mean": v_next.cpu().mean().data.item(),
@@ -154,8 +175,7 @@ class RAMBO(MBPO):
         self.dynamics.train()
         
         adv_loss, adv_q_loss, next_obs, adv_stats = self.compute_dynamics_adversarial_loss(obs, act)
-        reward_loss = self.reward.compute_loss(sl_batch["obs"], sl_batch["act"], sl_batch["rwd"])
-        dynamics_loss = self.dynamics.compute_loss(sl_batch["obs"], sl_batch["act"], sl_batch["next_obs"])
+        dynamics_loss, reward_loss = self.compute_model_loss(sl_batch)
         total_loss = self.obs_penalty * (reward_loss + dynamics_loss) + self.adv_penalty * adv_loss
         total_loss.backward()
         if self.update_critic_adv:
@@ -163,11 +183,13 @@ class RAMBO(MBPO):
         
         # if self.grad_clip is not None:
         #     nn.utils.clip_grad_norm_(self.parameters(), self.grad_clip)
-        self.optimizers["reward"].step()
+        if not self.fused:
+            self.optimizers["reward"].step()
         self.optimizers["dynamics"].step()
         if self.update_critic_adv:
             self.optimizers["critic"].step()
-        self.optimizers["reward"].zero_grad()
+        if not self.fused:
+            self.optimizers["reward"].zero_grad()
         self.optimizers["dynamics"].zero_grad()
         self.optimizers["critic"].zero_grad()
         self.optimizers["actor"].zero_grad()
@@ -200,12 +222,10 @@ class RAMBO(MBPO):
         data = self.real_buffer.sample(num_total)
 
         # normalize data
-        data["obs"] = normalize(data["obs"], self.dynamics.obs_mean.cpu(), self.dynamics.obs_variance.cpu())
-        data["next_obs"] = normalize(data["next_obs"], self.dynamics.obs_mean.cpu(), self.dynamics.obs_variance.cpu())
-        data["rwd"] = normalize(data["rwd"], self.reward.out_mean.cpu(), self.reward.out_variance.cpu())
+        data = self.normalize_model_data(data)
 
-        train_data = {k:v[:-num_eval].to(self.device) for k, v in data.items()}
-        eval_data = {k:v[-num_eval:].to(self.device) for k, v in data.items()}
+        train_data = {k:v[:-num_eval] for k, v in data.items()}
+        eval_data = {k:v[-num_eval:] for k, v in data.items()}
 
         # shuffle train data
         idx_train = np.arange(len(train_data["obs"]))
@@ -246,13 +266,22 @@ class RAMBO(MBPO):
         train_stats_epoch = pd.DataFrame(train_stats_epoch).mean(0).to_dict()
 
         # evaluate
-        reward_eval_stats = self.reward.evaluate(eval_data["obs"], eval_data["act"], eval_data["rwd"])
-        dynamics_eval_stats = self.dynamics.evaluate(eval_data["obs"], eval_data["act"], eval_data["next_obs"])
-        self.reward.update_topk_dist(reward_eval_stats)
-        self.dynamics.update_topk_dist(dynamics_eval_stats)
+        reward_eval_stats = self.reward.evaluate(
+            eval_data["obs"], eval_data["act"], eval_data["rwd"], self.eval_chunk_size
+        )
+        dynamics_eval_stats = self.dynamics.evaluate(
+            eval_data["obs"], eval_data["act"], eval_data["next_obs"], self.eval_chunk_size
+        )
+        if self.fused:
+            self.model.update_split_topk_dist(dynamics_eval_stats, reward_eval_stats)
+        else:
+            self.reward.update_topk_dist(reward_eval_stats)
+            self.dynamics.update_topk_dist(dynamics_eval_stats)
         eval_stats = {
             "rwd_mae": reward_eval_stats["mae"],
             "obs_mae": dynamics_eval_stats["mae"],
+            "rwd_nll": reward_eval_stats["nll"],
+            "obs_nll": dynamics_eval_stats["nll"],
         }
         if logger is not None:
             logger.push(eval_stats)
@@ -268,63 +297,79 @@ class RAMBO(MBPO):
         start_time = time.time()
         total_steps = epochs * steps_per_epoch
         
+        executor, rollout_agent, rollout_future = None, None, None
+        if self.overlap_rollout:
+            executor = ThreadPoolExecutor(max_workers=1)
+            rollout_agent = self.copy_rollout_agent()
+        
         epoch = 0
-        for t in range(total_steps):
-            # train model adversary
-            if (t + 1) % update_model_every == 0:
-                model_stats_epoch = self.train_adversarial_model_epoch(self.m_steps, rollout_steps, logger=logger)
-                if verbose:
-                    round_loss_dict = {k: round(v, 3) for k, v in model_stats_epoch.items()}
-                    print(f"e: {epoch + 1}, t model: {t + 1}, {round_loss_dict}")
+        try:
+            for t in range(total_steps):
+                # train model adversary
+                if (t + 1) % update_model_every == 0:
+                    model_stats_epoch = self.train_adversarial_model_epoch(self.m_steps, rollout_steps, logger=logger)
+                    if verbose:
+                        round_loss_dict = {k: round(v, 3) for k, v in model_stats_epoch.items()}
+                        print(f"e: {epoch + 1}, t model: {t + 1}, {round_loss_dict}")
 
-            # train model
-            if t == 0 or (t + 1) % sample_model_every == 0:
-                # generate imagined data
-                rollout_steps = self.compute_rollout_steps(epoch + 1)
-                self.replay_buffer.max_size = min(
-                    self.buffer_size, int(self.model_retain_epochs * self.rollout_batch_size * rollout_steps)
-                )
-                self.sample_imagined_data(
-                    self.rollout_batch_size, rollout_steps, mix=False
-                )
-                print("rollout_steps: {}, real buffer size: {}, fake buffer size: {}".format(
-                    rollout_steps, self.real_buffer.size, self.replay_buffer.size
-                ))
+                # train model
+                if t == 0 or (t + 1) % sample_model_every == 0:
+                    # generate imagined data
+                    rollout_steps = self.compute_rollout_steps(epoch + 1)
+                    if self.overlap_rollout:
+                        rollout_future = self.sample_imagined_data_async(
+                            executor, rollout_future, rollout_agent, self.rollout_batch_size, rollout_steps
+                        )
+                    else:
+                        self.new_model_generation(rollout_steps)
+                        self.sample_imagined_data(
+                            self.rollout_batch_size, rollout_steps, mix=False
+                        )
+                    print("rollout_steps: {}, real buffer size: {}, fake buffer size: {}".format(
+                        rollout_steps, self.real_buffer.size, self.replay_buffer.size
+                    ))
 
-            # train policy
-            policy_stats_epoch = self.train_policy_epoch(
-                logger=logger
-            )
-            if (t + 1) % verbose == 0:
-                round_loss_dict = {k: round(v, 3) for k, v in policy_stats_epoch.items()}
-                print(f"e: {epoch + 1}, t policy: {t + 1}, {round_loss_dict}")
+                # train policy
+                policy_stats_epoch = self.train_policy_epoch(
+                    logger=logger
+                )
+                if (t + 1) % verbose == 0:
+                    round_loss_dict = {k: round(v, 3) for k, v in policy_stats_epoch.items()}
+                    print(f"e: {epoch + 1}, t policy: {t + 1}, {round_loss_dict}")
 
-            # end of epoch handeling
-            if (t + 1) % steps_per_epoch == 0: 
-                epoch = (t + 1) // steps_per_epoch
+                # end of epoch handeling
+                if (t + 1) % steps_per_epoch == 0: 
+                    epoch = (t + 1) // steps_per_epoch
 
-                # evaluate episodes
-                if num_eval_eps > 0:
-                    eval_eps = []
-                    for i in range(num_eval_eps):
-                        eval_eps.append(self.rollout(eval_env, max_steps, sample_mean=eval_deterministic))
+                    # evaluate episodes
+                    if num_eval_eps > 0:
+                        eval_eps = []
+                        for i in range(num_eval_eps):
+                            eval_eps.append(self.rollout(eval_env, max_steps, sample_mean=eval_deterministic))
 
-                        # compute estimated return 
-                        with torch.no_grad():
-                            r, _ = self.reward.step(
-                                eval_eps[-1]["obs"].to(self.device),
-                                eval_eps[-1]["act"].to(self.device)
-                            )
-                        logger.push({"eval_eps_est_return": sum(r.cpu())})
-                        logger.push({"eval_eps_return": sum(eval_eps[-1]["rwd"])})
-                        logger.push({"eval_eps_len": sum(1 - eval_eps[-1]["done"])})
+                            # compute estimated return 
+                            with torch.no_grad():
+                                r, _ = self.reward.step(
+                                    eval_eps[-1]["obs"].to(self.device),
+                                    eval_eps[-1]["act"].to(self.device)
+                                )
+                            logger.push({"eval_eps_est_return": sum(r.cpu())})
+                            logger.push({"eval_eps_return": sum(eval_eps[-1]["rwd"])})
+                            logger.push({"eval_eps_len": sum(1 - eval_eps[-1]["done"])})
 
-                logger.push({"epoch": epoch + 1})
-                logger.push({"time": time.time() - start_time})
-                logger.log()
-                print()
+                    logger.push({"epoch": epoch + 1})
+                    logger.push({"time": time.time() - start_time})
+                    logger.log()
+                    print()
 
-                if callback is not None:
-                    callback(self, pd.DataFrame(logger.history))
+                    if callback is not None:
+                        callback(self, pd.DataFrame(logger.history))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+        
+        # surface errors of the last pending rollouts which are not used
+        if rollout_future is not None and not rollout_future.cancelled():
+            rollout_future.result()
         
         return logger
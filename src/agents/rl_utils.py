@@ -1,4 +1,6 @@
+import os
 import pprint
+from itertools import islice
 import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
@@ -11,40 +13,107 @@ def collate_fn(batch, pad_value=0):
     mask = pad_sequence([torch.ones(len(b[keys[0]])) for b in batch])
     return pad_batch, mask
 
+def pack_fn(batch):
+    """ Concatenate batch of dict along the sequence dimension without padding 
+    
+    Args:
+        batch (list): list of dict of tensors. size=[seq_len, dim]
+
+    Returns:
+        pack_batch (dict): concatenated tensors with additional fields eps_id and step. size=[num_transitions, dim]
+        offsets (torch.tensor): episode start offsets with the total length appended. size=[batch_size + 1]
+    """
+    assert isinstance(batch[0], dict)
+    keys = list(batch[0].keys())
+    pack_batch = {k: torch.cat([b[k] for b in batch], dim=0) for k in keys}
+    
+    eps_len = torch.tensor([len(b[keys[0]]) for b in batch])
+    offsets = torch.cat([torch.zeros(1, dtype=torch.long), torch.cumsum(eps_len, dim=0)])
+    pack_batch["eps_id"] = torch.repeat_interleave(torch.arange(len(batch)), eps_len)
+    pack_batch["step"] = torch.arange(offsets[-1]) - offsets[pack_batch["eps_id"]]
+    return pack_batch, offsets
+
+def discounted_segment_sum(x, eps_id, step, num_eps, gamma):
+    """ Compute discounted sum of packed sequences per episode 
+
+    Args:
+        x (torch.tensor): packed values. size=[num_transitions]
+        eps_id (torch.tensor): episode index of each value. size=[num_transitions]
+        step (torch.tensor): step index within episode of each value. size=[num_transitions]
+        num_eps (int): number of episodes
+        gamma (float): discount factor
+
+    Returns:
+        out (torch.tensor): discounted sum. size=[num_eps]
+    """
+    discount = gamma ** step.to(x.dtype)
+    out = torch.zeros(num_eps, dtype=x.dtype, device=x.device)
+    return out.index_add_(0, eps_id.to(x.device), discount * x)
+
+def get_episode_offsets(terminated, timeout):
+    """ Find episode boundaries of stacked trajectories 
+    
+    Args:
+        terminated (np.array): terminal flags. size=[num_transitions, ...]
+        timeout (np.array): timeout flags. size=[num_transitions, ...]
+
+    Returns:
+        eps_start (np.array): episode start index. size=[num_eps]
+        eps_end (np.array): episode end index (exclusive). size=[num_eps]
+    """
+    num_transitions = len(terminated)
+    eps_end = np.flatnonzero(np.logical_or(terminated, timeout).reshape(num_transitions, -1).any(-1)) + 1
+    if len(eps_end) == 0 or eps_end[-1] != num_transitions:
+        eps_end = np.append(eps_end, num_transitions) # unfinished last episode
+    eps_start = np.insert(eps_end[:-1], 0, 0)
+    return eps_start, eps_end
+
+def iter_stacked_trajectories(obs, act, rwd, next_obs, terminated, timeout):
+    """ Lazily yield episodes of stacked trajectories as views of the input arrays """
+    eps_start, eps_end = get_episode_offsets(terminated, timeout)
+    for start, end in zip(eps_start.tolist(), eps_end.tolist()):
+        yield {
+            "obs": obs[start:end],
+            "act": act[start:end],
+            "rwd": rwd[start:end],
+            "next_obs": next_obs[start:end],
+            "done": terminated[start:end],
+        }
+
 def parse_stacked_trajectories(obs, act, rwd, next_obs, terminated, timeout, max_eps=None):
-    eps_id = np.cumsum(terminated + timeout)
-    eps_id = np.insert(eps_id, 0, 0)[:-1] # offset by 1 step
-    max_eps = eps_id.max() + 1 if max_eps is None else max_eps
-
-    dataset = []
-    for e in np.unique(eps_id):
-        dataset.append({
-            "obs": obs[eps_id == e],
-            "act": act[eps_id == e],
-            "rwd": rwd[eps_id == e],
-            "next_obs": next_obs[eps_id == e],
-            "done": terminated[eps_id == e],
-        })
-
-        if (e + 1) >= max_eps:
-            break
-    return dataset
-
-def update_moving_stats(x, old_mean, old_mean_square, old_variance, size, momentum):
-    """ Compute moving mean and variance stats from batch data """
-    batch_size = len(x)
-    new_mean = (old_mean * size + np.sum(x, axis=0)) / (size + batch_size)
-    new_mean_square = (old_mean_square * size + np.sum(x**2, axis=0)) / (size + batch_size)
-    new_variance = new_mean_square - new_mean**2
-    
-    # print(old_mean, size)
-    # print(x.mean(0))
-    # print("new mean", new_mean)
-
-    new_mean = old_mean * momentum + new_mean * (1 - momentum)
-    new_mean_square = old_mean_square * momentum + new_mean_square * (1 - momentum)
-    new_variance = old_variance * momentum + new_variance * (1 - momentum)
-    return new_mean, new_mean_square, new_variance
+    """ Split stacked trajectories into a list of episode dicts of array views """
+    return list(islice(
+        iter_stacked_trajectories(obs, act, rwd, next_obs, terminated, timeout), max_eps
+    ))
+
+def sample_idx(rng, size, batch_size, replace=False):
+    """ Sample indices from range(size) without building the full index array
+
+    Args:
+        rng (np.random.Generator): random number generator
+        size (int): population size
+        batch_size (int): number of samples. Capped at size if replace=False
+        replace (bool, optional): whether to sample with replacement. Default=False
+
+    Returns:
+        idx (np.array): sampled indices. size=[batch_size]
+    """
+    if replace:
+        return rng.integers(0, size, batch_size)
+    
+    batch_size = min(batch_size, size)
+    if 4 * batch_size > size:
+        return rng.permutation(size)[:batch_size]
+    
+    # Floyd's algorithm, O(batch_size) time and memory
+    j = np.arange(size - batch_size, size)
+    t = rng.integers(0, j + 1)
+    selected = set()
+    for t_, j_ in zip(t.tolist(), j.tolist()):
+        selected.add(j_ if t_ in selected else t_)
+    idx = np.fromiter(selected, dtype=np.int64, count=batch_size)
+    rng.shuffle(idx)
+    return idx
 
 def normalize(x, mean, variance):
     return (x - mean) / variance**0.5
@@ -53,67 +122,168 @@ def denormalize(x, mean, variance):
     return x * variance**0.5 + mean
 
 
+class RunningStats:
+    def __init__(self, dim, momentum=0., max_count=None):
+        """ Streaming mean and variance using Chan's parallel merge of Welford statistics
+
+        Args:
+            dim (int): data dimension
+            momentum (float, optional): exponential moving average weight of old stats. Default=0.
+            max_count (int, optional): maximum count of old samples in the merge. 
+                Used to track the stats of a finite buffer. If None, count all samples. Default=None
+        """
+        self.dim = dim
+        self.momentum = momentum
+        self.max_count = max_count
+
+        self.count = 0
+        self.mean = np.zeros((dim,))
+        self.variance = np.ones((dim,))
+    
+    def update(self, x):
+        """ Merge a batch of data into the stats 
+        
+        Args:
+            x (np.array or torch.tensor): batch data. size=[batch_size, dim]. 
+                If x is a tensor, the stats are kept as float64 tensors on its device
+        """
+        batch_size = len(x)
+        if batch_size == 0:
+            return
+        
+        if isinstance(x, torch.Tensor):
+            x = x.detach().to(torch.float64)
+            self.mean = torch.as_tensor(self.mean, dtype=torch.float64, device=x.device)
+            self.variance = torch.as_tensor(self.variance, dtype=torch.float64, device=x.device)
+            batch_mean = x.mean(0)
+            batch_m2 = x.var(0, unbiased=False) * batch_size
+        else:
+            batch_mean = np.mean(x, axis=0, dtype=np.float64)
+            batch_m2 = np.var(x, axis=0, dtype=np.float64) * batch_size
+        
+        count = self.count
+        if self.max_count is not None:
+            count = min(count, self.max_count)
+        total = count + batch_size
+        
+        delta = batch_mean - self.mean
+        new_mean = self.mean + delta * batch_size / total
+        new_m2 = self.variance * count + batch_m2 + delta**2 * count * batch_size / total
+        new_variance = new_m2 / total
+
+        self.mean = self.mean * self.momentum + new_mean * (1 - self.momentum)
+        self.variance = self.variance * self.momentum + new_variance * (1 - self.momentum)
+        self.count = total
+
+
 class ReplayBuffer:
-    def __init__(self, obs_dim, act_dim, max_size, momentum=0.1):
+    def __init__(self, obs_dim, act_dim, max_size, momentum=0.1, seed=None):
         """ Replay buffer to store independent samples, episodes cannot be retrieved
 
+        Transitions are stored in preallocated arrays of size max_size and written 
+        in a circular fashion, so the oldest transitions are overwritten once the buffer is full.
+
         Args:
             obs_dim (int): observation dimension
             act_dim (int): action dimension
             max_size (int): maximum buffer size
             momentum (float, optional): moving stats momentum. Default=0.99
+            seed (int, optional): sampling random seed. If None, draw from numpy global random state. Default=None
         """
         self.obs_dim = obs_dim
         self.act_dim = act_dim
         self.size = 0
-        self.max_size = max_size
+        self.ptr = 0 # next write position
+        self.num_pushed = 0 # total number of pushed transitions
+        self._max_size = int(max_size)
         self.momentum = momentum
+        self.rng = np.random.default_rng(np.random.randint(2**31) if seed is None else seed)
 
-        self.obs = np.empty(shape=(0, obs_dim))
-        self.act = np.empty(shape=(0, act_dim))
-        self.rwd = np.empty(shape=(0, 1))
-        self.next_obs = np.empty(shape=(0, obs_dim))
-        self.done = np.empty(shape=(0, 1))
+        self.allocate(self._max_size)
         
         # batch placeholder
-        self.obs_batch = np.empty(shape=(0, obs_dim))
-        self.act_batch = np.empty(shape=(0, act_dim))
-        self.rwd_batch = np.empty(shape=(0, 1))
-        self.next_obs_batch = np.empty(shape=(0, obs_dim))
-        self.done_batch = np.empty(shape=(0, 1))
+        self.batch_ptr = 0 # number of temporarily stored transitions
+        self.allocate_batch(1000)
         
         # moving stats
-        self.obs_mean = np.zeros((obs_dim,))
-        self.obs_mean_square = np.zeros((obs_dim,))
-        self.obs_variance = np.ones((obs_dim, ))
-
-        self.rwd_mean = np.zeros((1,))
-        self.rwd_mean_square = np.zeros((1,))
-        self.rwd_variance = np.ones((1,))
+        self.obs_stats = RunningStats(obs_dim, momentum, max_count=self._max_size)
+        self.rwd_stats = RunningStats(1, momentum, max_count=self._max_size)
+        self.obs_mean = self.obs_stats.mean
+        self.obs_variance = self.obs_stats.variance
+        self.rwd_mean = self.rwd_stats.mean
+        self.rwd_variance = self.rwd_stats.variance
     
-    def clear(self):
-        self.obs = np.empty(shape=(0, self.obs_dim))
-        self.act = np.empty(shape=(0, self.act_dim))
-        self.rwd = np.empty(shape=(0, 1))
-        self.next_obs = np.empty(shape=(0, self.obs_dim))
-        self.done = np.empty(shape=(0, 1))
+    @property
+    def max_size(self):
+        return self._max_size
+    
+    @max_size.setter
+    def max_size(self, max_size):
+        """ Reallocate storage and keep the latest transitions """
+        max_size = int(max_size)
+        if max_size == self._max_size:
+            return
         
-        # batch placeholder
-        self.obs_batch = np.empty(shape=(0, self.obs_dim))
-        self.act_batch = np.empty(shape=(0, self.act_dim))
-        self.rwd_batch = np.empty(shape=(0, 1))
-        self.next_obs_batch = np.empty(shape=(0, self.obs_dim))
-        self.done_batch = np.empty(shape=(0, 1))
+        num_keep = min(self.size, max_size)
+        idx = (self.ptr - num_keep + np.arange(num_keep)) % self._max_size
+        data = [self.obs[idx], self.act[idx], self.rwd[idx], self.next_obs[idx], self.done[idx]]
+        
+        self._max_size = max_size
+        self.obs_stats.max_count = max_size
+        self.rwd_stats.max_count = max_size
+        self.allocate(max_size)
+        self.write(0, *data)
+        self.size = num_keep
+        self.ptr = num_keep % max_size
+
+    def allocate(self, max_size):
+        """ Allocate transition storage """
+        self.obs = np.empty(shape=(max_size, self.obs_dim))
+        self.act = np.empty(shape=(max_size, self.act_dim))
+        self.rwd = np.empty(shape=(max_size, 1))
+        self.next_obs = np.empty(shape=(max_size, self.obs_dim))
+        self.done = np.empty(shape=(max_size, 1))
+    
+    def write(self, ptr, obs, act, rwd, next_obs, done):
+        """ Write a batch of less than max_size transitions starting from ptr with wrap around """
+        batch_size = len(obs)
+        num_tail = min(batch_size, self.max_size - ptr)
+        num_head = batch_size - num_tail
+        for storage, data in zip(
+            [self.obs, self.act, self.rwd, self.next_obs, self.done], 
+            [obs, act, rwd, next_obs, done]
+        ):
+            storage[ptr:ptr+num_tail] = data[:num_tail]
+            storage[:num_head] = data[num_tail:]
+    
+    def allocate_batch(self, batch_max_size):
+        """ Allocate batch placeholder and keep temporarily stored transitions """
+        new_batch = [
+            np.empty(shape=(batch_max_size, dim)) 
+            for dim in [self.obs_dim, self.act_dim, 1, self.obs_dim, 1]
+        ]
+        if self.batch_ptr > 0:
+            old_batch = [self.obs_batch, self.act_batch, self.rwd_batch, self.next_obs_batch, self.done_batch]
+            for old, new in zip(old_batch, new_batch):
+                new[:self.batch_ptr] = old[:self.batch_ptr]
+        self.obs_batch, self.act_batch, self.rwd_batch, self.next_obs_batch, self.done_batch = new_batch
 
+    def clear(self):
+        self.batch_ptr = 0
         self.size = 0
+        self.ptr = 0
 
     def push(self, obs, act, rwd, next_obs, done):
         """ Temporarily store """
-        self.obs_batch = np.concatenate([self.obs_batch, obs.reshape(1, -1)], axis=0)
-        self.act_batch = np.concatenate([self.act_batch, act.reshape(1, -1)], axis=0)
-        self.rwd_batch = np.concatenate([self.rwd_batch, rwd.reshape(1, -1)], axis=0)
-        self.next_obs_batch = np.concatenate([self.next_obs_batch, next_obs.reshape(1, -1)], axis=0)
-        self.done_batch = np.concatenate([self.done_batch, done.reshape(1, -1)], axis=0)
+        if self.batch_ptr == len(self.obs_batch):
+            self.allocate_batch(2 * len(self.obs_batch))
+
+        self.obs_batch[self.batch_ptr] = obs
+        self.act_batch[self.batch_ptr] = act
+        self.rwd_batch[self.batch_ptr] = rwd
+        self.next_obs_batch[self.batch_ptr] = next_obs
+        self.done_batch[self.batch_ptr] = done
+        self.batch_ptr += 1
 
     def push_batch(self, obs=None, act=None, rwd=None, next_obs=None, done=None):
         assert (
@@ -122,44 +292,56 @@ class ReplayBuffer:
         )
 
         if obs is None:
-            obs = self.obs_batch
-            act = self.act_batch
-            rwd = self.rwd_batch
-            next_obs = self.next_obs_batch
-            done = self.done_batch
-
-            self.obs_batch = np.empty(shape=(0, self.obs_dim))
-            self.act_batch = np.empty(shape=(0, self.act_dim))
-            self.rwd_batch = np.empty(shape=(0, 1))
-            self.next_obs_batch = np.empty(shape=(0, self.obs_dim))
-            self.done_batch = np.empty(shape=(0, 1))
-
-        batch_size = len(obs)
-
-        self.obs = np.concatenate([self.obs, obs.reshape(-1, self.obs_dim)], axis=0)
-        self.act = np.concatenate([self.act, act.reshape(-1, self.act_dim)], axis=0)
-        self.rwd = np.concatenate([self.rwd, rwd.reshape(-1, 1)], axis=0)
-        self.next_obs = np.concatenate([self.next_obs, next_obs.reshape(-1, self.obs_dim)], axis=0)
-        self.done = np.concatenate([self.done, done.reshape(-1, 1)], axis=0)
+            # views of the batch placeholder, copied into storage by self.write
+            obs = self.obs_batch[:self.batch_ptr]
+            act = self.act_batch[:self.batch_ptr]
+            rwd = self.rwd_batch[:self.batch_ptr]
+            next_obs = self.next_obs_batch[:self.batch_ptr]
+            done = self.done_batch[:self.batch_ptr]
+            self.batch_ptr = 0
+
+        obs = obs.reshape(-1, self.obs_dim)
+        act = act.reshape(-1, self.act_dim)
+        rwd = rwd.reshape(-1, 1)
+        next_obs = next_obs.reshape(-1, self.obs_dim)
+        done = done.reshape(-1, 1)
 
         self.update_stats(obs, rwd)
-        self.size += batch_size
-
-        if self.size > self.max_size:
-            size_diff = int(self.size - self.max_size)
-            
-            self.obs = self.obs[size_diff:]
-            self.act = self.act[size_diff:]
-            self.rwd = self.rwd[size_diff:]
-            self.next_obs = self.next_obs[size_diff:]
-            self.done = self.done[size_diff:]
-
-            self.size -= size_diff
-
-    def sample(self, batch_size):
-        batch_size = min(batch_size, self.size)
-        idx = np.random.choice(np.arange(self.size), batch_size, replace=False)
-
+        self.num_pushed += len(obs)
+        self.store(obs, act, rwd, next_obs, done)
+    
+    def store(self, obs, act, rwd, next_obs, done):
+        """ Write transitions to storage and only keep the latest max_size transitions """
+        batch_size = len(obs)
+        if batch_size > self.max_size:
+            size_diff = batch_size - self.max_size
+            obs = obs[size_diff:]
+            act = act[size_diff:]
+            rwd = rwd[size_diff:]
+            next_obs = next_obs[size_diff:]
+            done = done[size_diff:]
+            batch_size = self.max_size
+
+        self.write(self.ptr, obs, act, rwd, next_obs, done)
+        self.ptr = (self.ptr + batch_size) % self.max_size
+        self.size = min(self.size + batch_size, self.max_size)
+
+    def sample(self, batch_size, replace=False):
+        """ Sample random transitions 
+        
+        Args:
+            batch_size (int): sample batch size.
+            replace (bool, optional): whether to sample with replacement. Default=False
+        """
+        idx = sample_idx(self.rng, self.size, batch_size, replace=replace)
+        return self.get(idx)
+    
+    def get(self, idx):
+        """ Get transitions at storage indices 
+        
+        Args:
+            idx (np.array): storage indices. size=[batch_size]
+        """
         batch = dict(
             obs=self.obs[idx], 
             act=self.act[idx], 
@@ -174,47 +356,471 @@ class ReplayBuffer:
 
     def update_stats(self, obs, rwd):
         """ Update observation and reward moving mean and variance """
-        self.obs_mean, self.obs_mean_square, self.obs_variance = update_moving_stats(
-            obs, self.obs_mean, self.obs_mean_square, self.obs_variance, self.size, self.momentum
+        self.obs_stats.update(obs)
+        self.rwd_stats.update(rwd)
+        
+        self.obs_mean = self.obs_stats.mean
+        self.obs_variance = self.obs_stats.variance
+        self.rwd_mean = self.rwd_stats.mean
+        self.rwd_variance = self.rwd_stats.variance
+
+
+class TorchReplayBuffer(ReplayBuffer):
+    def __init__(self, obs_dim, act_dim, max_size, momentum=0.1, seed=None, device=torch.device("cpu")):
+        """ Replay buffer storing float32 tensors on the training device
+
+        Args:
+            obs_dim (int): observation dimension
+            act_dim (int): action dimension
+            max_size (int): maximum buffer size
+            momentum (float, optional): moving stats momentum. Default=0.99
+            seed (int, optional): sampling random seed. If None, draw from numpy global random state. Default=None
+            device (torch.device, optional): storage device. Default=cpu
+        """
+        self.device = device
+        super().__init__(obs_dim, act_dim, max_size, momentum, seed)
+    
+    def allocate(self, max_size):
+        """ Allocate transition storage """
+        self.obs = torch.empty(max_size, self.obs_dim, dtype=torch.float32, device=self.device)
+        self.act = torch.empty(max_size, self.act_dim, dtype=torch.float32, device=self.device)
+        self.rwd = torch.empty(max_size, 1, dtype=torch.float32, device=self.device)
+        self.next_obs = torch.empty(max_size, self.obs_dim, dtype=torch.float32, device=self.device)
+        self.done = torch.empty(max_size, 1, dtype=torch.float32, device=self.device)
+    
+    def write(self, ptr, obs, act, rwd, next_obs, done):
+        """ Write a batch of numpy arrays or tensors starting from ptr with wrap around """
+        data = [
+            torch.as_tensor(x, dtype=torch.float32, device=self.device) 
+            for x in [obs, act, rwd, next_obs, done]
+        ]
+        super().write(ptr, *data)
+
+    def get(self, idx):
+        """ Get transitions at storage indices 
+        
+        Args:
+            idx (np.array): storage indices. size=[batch_size]
+        """
+        idx = torch.as_tensor(idx, device=self.device)
+        batch = dict(
+            obs=self.obs[idx], 
+            act=self.act[idx], 
+            rwd=self.rwd[idx], 
+            next_obs=self.next_obs[idx], 
+            done=self.done[idx],
+        )
+        return batch
+
+    def update_stats(self, obs, rwd):
+        """ Update observation and reward moving mean and variance on the storage device """
+        obs = torch.as_tensor(obs, device=self.device)
+        rwd = torch.as_tensor(rwd, device=self.device)
+        super().update_stats(obs, rwd)
+
+
+class SegmentedReplayBuffer(ReplayBuffer):
+    def __init__(self, obs_dim, act_dim, num_segments, segment_size, momentum=0.1, seed=None, **kwargs):
+        """ Replay buffer made of fixed size segments, one per generation of data
+
+        Transitions of the current generation are written into the current segment. Starting a new generation 
+        overwrites the oldest segment, so only the latest num_segments generations are kept. 
+        Samples are drawn uniformly from transitions of all live segments.
+
+        Args:
+            obs_dim (int): observation dimension
+            act_dim (int): action dimension
+            num_segments (int): number of generations to keep
+            segment_size (int): maximum number of transitions per generation
+            momentum (float, optional): moving stats momentum. Default=0.99
+            seed (int, optional): sampling random seed. If None, draw from numpy global random state. Default=None
+        """
+        self.num_segments = num_segments
+        self.segment_size = int(segment_size)
+        self.segment_sizes = np.zeros(num_segments, dtype=np.int64)
+        self.segment_ptr = num_segments - 1 # current segment, the first new segment starts at 0
+        self.segment_offset = 0 # next write position in current segment
+        super().__init__(obs_dim, act_dim, num_segments * self.segment_size, momentum, seed, **kwargs)
+    
+    @property
+    def max_size(self):
+        return self._max_size
+    
+    @max_size.setter
+    def max_size(self, max_size):
+        raise AttributeError("max_size of segmented buffer is read-only, segmented buffer is resized by new_segment")
+    
+    def resize_segments(self, segment_size):
+        """ Reallocate storage with larger segments and keep transitions of all live segments. 
+        Live slices of the old storage are copied directly without changing dtype 
+        """
+        data = []
+        for k in range(self.num_segments):
+            start = k * self.segment_size
+            end = start + self.segment_sizes[k]
+            data.append([storage[start:end] for storage in [self.obs, self.act, self.rwd, self.next_obs, self.done]])
+        
+        self.segment_size = int(segment_size)
+        self._max_size = self.num_segments * self.segment_size
+        self.obs_stats.max_count = self._max_size
+        self.rwd_stats.max_count = self._max_size
+        self.allocate(self._max_size)
+        for k, batch in enumerate(data):
+            self.write(k * self.segment_size, *batch)
+    
+    def new_segment(self, segment_size=None):
+        """ Start a new generation by clearing the oldest segment 
+        
+        Args:
+            segment_size (int, optional): maximum number of transitions of the new generation. 
+                Storage is reallocated if larger than the current segment size. Default=None
+        """
+        if segment_size is not None and segment_size > self.segment_size:
+            self.resize_segments(segment_size)
+        
+        self.segment_ptr = (self.segment_ptr + 1) % self.num_segments
+        self.segment_sizes[self.segment_ptr] = 0
+        self.segment_offset = 0
+        self.size = int(self.segment_sizes.sum())
+    
+    def clear(self):
+        super().clear()
+        self.segment_sizes[:] = 0
+        self.segment_ptr = self.num_segments - 1
+        self.segment_offset = 0
+    
+    def store(self, obs, act, rwd, next_obs, done):
+        """ Write transitions into the current segment and only keep its latest segment_size transitions """
+        batch_size = len(obs)
+        if batch_size > self.segment_size:
+            size_diff = batch_size - self.segment_size
+            obs = obs[size_diff:]
+            act = act[size_diff:]
+            rwd = rwd[size_diff:]
+            next_obs = next_obs[size_diff:]
+            done = done[size_diff:]
+            batch_size = self.segment_size
+        
+        # wrap around within the segment
+        start = self.segment_ptr * self.segment_size
+        num_tail = min(batch_size, self.segment_size - self.segment_offset)
+        self.write(
+            start + self.segment_offset, 
+            obs[:num_tail], act[:num_tail], rwd[:num_tail], next_obs[:num_tail], done[:num_tail]
         )
+        if num_tail < batch_size:
+            self.write(
+                start, 
+                obs[num_tail:], act[num_tail:], rwd[num_tail:], next_obs[num_tail:], done[num_tail:]
+            )
+        
+        self.segment_offset = (self.segment_offset + batch_size) % self.segment_size
+        self.segment_sizes[self.segment_ptr] = min(self.segment_sizes[self.segment_ptr] + batch_size, self.segment_size)
+        self.size = int(self.segment_sizes.sum())
+    
+    def sample(self, batch_size, replace=False):
+        """ Sample random transitions uniformly from all live segments 
+        
+        Args:
+            batch_size (int): sample batch size.
+            replace (bool, optional): whether to sample with replacement. Default=False
+        """
+        idx = sample_idx(self.rng, self.size, batch_size, replace=replace)
+        
+        # map positions among live transitions to storage indices
+        segment_ends = np.cumsum(self.segment_sizes)
+        segment = np.searchsorted(segment_ends, idx, side="right")
+        offset = idx - (segment_ends[segment] - self.segment_sizes[segment])
+        return self.get(segment * self.segment_size + offset)
+
+
+class TorchSegmentedReplayBuffer(SegmentedReplayBuffer, TorchReplayBuffer):
+    """ Segmented replay buffer storing float32 tensors on the training device. 
+    Takes the SegmentedReplayBuffer arguments and a device keyword argument 
+    """
+    pass
+
+
+class SumTree:
+    def __init__(self, max_size):
+        """ Binary sum tree over max_size leaves for O(log n) priority update and prefix sum search 
+        
+        Args:
+            max_size (int): number of leaves
+        """
+        self.max_size = max_size
+        self.depth = max(1, (max_size - 1).bit_length())
+        self.num_leaves = 2 ** self.depth
+        self.tree = np.zeros(2 * self.num_leaves) # root at index 1, leaves at [num_leaves, 2 * num_leaves)
+    
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, idx):
+        return self.tree[idx + self.num_leaves]
+
+    def update(self, idx, value):
+        """ Set leaf values and update parent sums level by level """
+        pos = np.asarray(idx) + self.num_leaves
+        self.tree[pos] = value
+        for _ in range(self.depth):
+            pos = np.unique(pos // 2)
+            self.tree[pos] = self.tree[2 * pos] + self.tree[2 * pos + 1]
+    
+    def find(self, prefix):
+        """ Find leaf indices whose cumulative sum interval contains prefix. 
+        Only descend into subtrees with positive mass so prefixes at or beyond the total 
+        due to rounding still end on a leaf with positive priority 
+        """
+        prefix = np.array(prefix, dtype=np.float64)
+        pos = np.ones(len(prefix), dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * pos]
+            go_right = (prefix >= left) & (self.tree[2 * pos + 1] > 0)
+            prefix -= left * go_right
+            pos = 2 * pos + go_right
+        return pos - self.num_leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    def __init__(self, obs_dim, act_dim, max_size, momentum=0.1, seed=None, alpha=0.6, beta=0.4, beta_steps=1e5, eps=1e-6):
+        """ Replay buffer with proportional prioritized sampling
+
+        New transitions receive the maximum priority seen so far. 
+        Sampled batches contain importance weights and buffer indices for priority update. 
+        The importance weight exponent is linearly annealed from beta to 1 over beta_steps sample calls.
+
+        Args:
+            obs_dim (int): observation dimension
+            act_dim (int): action dimension
+            max_size (int): maximum buffer size
+            momentum (float, optional): moving stats momentum. Default=0.99
+            seed (int, optional): sampling random seed. If None, draw from numpy global random state. Default=None
+            alpha (float, optional): priority exponent. Default=0.6
+            beta (float, optional): initial importance weight exponent. Default=0.4
+            beta_steps (int, optional): number of sample calls to anneal importance weight exponent to 1. Default=1e5
+            eps (float, optional): minimum priority. Default=1e-6
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_steps = beta_steps
+        self.eps = eps
+        self.max_priority = 1.
+        self.num_sampled = 0 # number of sample calls for beta annealing
+        super().__init__(obs_dim, act_dim, max_size, momentum, seed)
+    
+    @ReplayBuffer.max_size.setter
+    def max_size(self, max_size):
+        """ Reallocate storage and keep the latest transitions with their priorities """
+        max_size = int(max_size)
+        if max_size == self._max_size:
+            return
+        
+        num_keep = min(self.size, max_size)
+        idx = (self.ptr - num_keep + np.arange(num_keep)) % self._max_size
+        priority = self.tree.get(idx)
+        ReplayBuffer.max_size.fset(self, max_size)
+        if num_keep > 0:
+            self.tree.update(np.arange(num_keep), priority)
+    
+    @property
+    def current_beta(self):
+        """ Annealed importance weight exponent """
+        return min(1., self.beta + (1. - self.beta) * self.num_sampled / self.beta_steps)
+    
+    def allocate(self, max_size):
+        """ Allocate transition storage and priority tree """
+        super().allocate(max_size)
+        self.tree = SumTree(max_size)
+
+    def write(self, ptr, obs, act, rwd, next_obs, done):
+        """ Write a batch of transitions with max priority """
+        super().write(ptr, obs, act, rwd, next_obs, done)
+        idx = (ptr + np.arange(len(obs))) % self.max_size
+        self.tree.update(idx, self.max_priority)
+    
+    def clear(self):
+        super().clear()
+        self.tree = SumTree(self.max_size)
+        self.max_priority = 1.
+
+    def sample(self, batch_size, replace=True):
+        """ Sample transitions proportional to priority with stratified sampling 
+        
+        Args:
+            batch_size (int): sample batch size.
+            replace (bool, optional): whether to sample with replacement. 
+                Prioritized samples are always drawn with replacement so only True is supported. Default=True
 
-        self.rwd_mean, self.rwd_mean_square, self.rwd_variance = update_moving_stats(
-            rwd, self.rwd_mean, self.rwd_mean_square, self.rwd_variance, self.size, self.momentum
+        Returns:
+            batch (dict): transitions with additional fields weight (importance weight), idx (buffer index), 
+                and priority_mask (rows to update priorities with, all True)
+        """
+        if not replace:
+            raise ValueError("prioritized replay buffer only samples with replacement")
+        
+        segment = self.tree.total / batch_size
+        prefix = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        idx = self.tree.find(prefix)
+        
+        prob = self.tree.get(idx) / self.tree.total
+        weight = (self.size * prob) ** -self.current_beta
+        weight /= weight.max()
+        self.num_sampled += 1
+
+        batch = dict(
+            obs=self.obs[idx], 
+            act=self.act[idx], 
+            rwd=self.rwd[idx], 
+            next_obs=self.next_obs[idx], 
+            done=self.done[idx],
+            weight=weight.reshape(-1, 1),
         )
+        batch = {k: torch.from_numpy(v).to(torch.float32) for k, v in batch.items()}
+        batch["idx"] = torch.from_numpy(idx)
+        batch["priority_mask"] = torch.ones(batch_size, dtype=torch.bool)
+        return batch
+    
+    def update_priorities(self, idx, td_error):
+        """ Update priorities of sampled transitions with absolute td errors """
+        if isinstance(idx, torch.Tensor):
+            idx = idx.cpu().numpy()
+        if isinstance(td_error, torch.Tensor):
+            td_error = td_error.data.cpu().numpy()
+        
+        priority = (np.abs(td_error.flatten()) + self.eps) ** self.alpha
+        self.tree.update(idx, priority)
+        self.max_priority = max(self.max_priority, priority.max())
+
+
+class MemmapReplayBuffer(ReplayBuffer):
+    keys = ["obs", "act", "rwd", "next_obs", "done"]
+
+    def __init__(self, path, momentum=0., seed=None, mmap_mode="r", chunk_size=100000):
+        """ Replay buffer backed by memory-mapped .npy files in a directory
+
+        The directory contains obs.npy, act.npy, rwd.npy, next_obs.npy, done.npy, and optionally timeout.npy, 
+        e.g. created by scripts/convert_d4rl_data.py. Transitions are read from disk on sampling, 
+        so the dataset does not need to fit in memory and the page cache is shared across processes. 
+        Timeout flags are not sampled and only used to recover episode boundaries.
+
+        Args:
+            path (str): data directory
+            momentum (float, optional): moving stats momentum. Default=0.
+            seed (int, optional): sampling random seed. If None, draw from numpy global random state. Default=None
+            mmap_mode (str, optional): numpy memmap mode. Use "r" for read-only and "r+" to allow push. Default="r"
+            chunk_size (int, optional): number of transitions read at a time to compute stats. Default=100000
+        """
+        self.path = path
+        self.mmap_mode = mmap_mode
+        obs = np.load(os.path.join(path, "obs.npy"), mmap_mode="r")
+        act = np.load(os.path.join(path, "act.npy"), mmap_mode="r")
+        super().__init__(obs.shape[-1], act.shape[-1], len(obs), momentum, seed)
+        
+        self.timeout = None
+        timeout_path = os.path.join(path, "timeout.npy")
+        if os.path.exists(timeout_path):
+            self.timeout = np.load(timeout_path, mmap_mode="r").reshape(self.max_size, -1)
+        
+        # stream stats over the full dataset without loading it
+        for i in range(0, self.max_size, chunk_size):
+            self.update_stats(self.obs[i:i+chunk_size], self.rwd[i:i+chunk_size])
+        self.size = self.max_size
+        self.num_pushed = self.size
+        self.ptr = 0
+
+    @property
+    def max_size(self):
+        return self._max_size
+    
+    @max_size.setter
+    def max_size(self, max_size):
+        raise AttributeError("max_size of memory-mapped buffer is read-only, memory-mapped buffer cannot be resized")
+
+    def allocate(self, max_size):
+        """ Open memory-mapped transition storage """
+        for key in self.keys:
+            storage = np.load(os.path.join(self.path, f"{key}.npy"), mmap_mode=self.mmap_mode)
+            assert len(storage) == max_size
+            setattr(self, key, storage.reshape(max_size, -1))
+
+    def episode_offsets(self):
+        """ Find episode boundaries from terminal and timeout flags on disk. 
+        Without timeout.npy, only terminal transitions end episodes
+
+        Returns:
+            eps_start (np.array): episode start index. size=[num_eps]
+            eps_end (np.array): episode end index (exclusive). size=[num_eps]
+        """
+        timeout = self.timeout if self.timeout is not None else np.zeros(self.done.shape)
+        return get_episode_offsets(self.done, timeout)
+
+    def push_batch(self, obs=None, act=None, rwd=None, next_obs=None, done=None):
+        """ Overwrite transitions on disk, only supported when opened with mmap_mode r+. Timeout flags are not overwritten """
+        if self.mmap_mode != "r+":
+            raise ValueError("memory-mapped buffer is read-only, open with mmap_mode='r+' to write")
+        super().push_batch(obs, act, rwd, next_obs, done)
+
+    def sample(self, batch_size, replace=False):
+        """ Sample random transitions """
+        idx = sample_idx(self.rng, self.size, batch_size, replace)
+        return self.get(idx)
+    
+    def get(self, idx):
+        """ Get transitions at storage indices, reading from disk in sorted order for sequential access """
+        order = np.argsort(idx)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        
+        batch = {}
+        for key in self.keys:
+            data = np.asarray(getattr(self, key)[idx[order]])[inverse]
+            batch[key] = torch.from_numpy(data).to(torch.float32)
+        return batch
 
 
 class EpisodeReplayBuffer:
-    def __init__(self, obs_dim, act_dim, max_size, momentum=0.99):
+    def __init__(self, obs_dim, act_dim, max_size, momentum=0.99, seed=None):
         """ Replay buffer to store full episodes
 
+        Transitions of all episodes are stored contiguously in preallocated circular arrays, 
+        episodes are indexed by their start position and length in a circular episode table.
+
         Args:
             obs_dim (int): observation dimension
             act_dim (int): action dimension
             max_size (int): maximum buffer size
             momentum (float, optional): moving stats momentum. Default=0.99
+            seed (int, optional): sampling random seed. If None, draw from numpy global random state. Default=None
         """
         self.obs_dim = obs_dim
         self.act_dim = act_dim
-        self.eps_len = []
         self.num_eps = 0
         self.size = 0
-        self.max_size = max_size
+        self.ptr = 0 # next write position
+        self.eps_head = 0 # episode table position of the oldest episode
+        self.max_size = int(max_size)
         self.momentum = momentum
+        self.rng = np.random.default_rng(np.random.randint(2**31) if seed is None else seed)
 
-        self.obs_mean = np.zeros((obs_dim,))
-        self.obs_mean_square = np.zeros((obs_dim,))
-        self.obs_variance = np.ones((obs_dim, ))
-
-        self.rwd_mean = np.zeros((1,))
-        self.rwd_mean_square = np.zeros((1,))
-        self.rwd_variance = np.ones((1,))
+        self.obs_stats = RunningStats(obs_dim, momentum, max_count=self.max_size)
+        self.rwd_stats = RunningStats(1, momentum, max_count=self.max_size)
+        self.obs_mean = self.obs_stats.mean
+        self.obs_variance = self.obs_stats.variance
+        self.rwd_mean = self.rwd_stats.mean
+        self.rwd_variance = self.rwd_stats.variance
 
         # placeholder for all episodes
-        self.obs = []
-        self.act = []
-        self.rwd = []
-        self.next_obs = []
-        self.done = []
+        self.obs = np.empty(shape=(self.max_size, obs_dim))
+        self.act = np.empty(shape=(self.max_size, act_dim))
+        self.rwd = np.empty(shape=(self.max_size, 1))
+        self.next_obs = np.empty(shape=(self.max_size, obs_dim))
+        self.done = np.empty(shape=(self.max_size, 1))
+
+        # episode table, every episode has at least one transition
+        self.eps_start = np.zeros(self.max_size, dtype=np.int64)
+        self.eps_len = np.zeros(self.max_size, dtype=np.int64)
         
         # placeholder for a single episode
         self.obs_eps = [] # store a single episode
@@ -232,15 +838,10 @@ class EpisodeReplayBuffer:
         self.done_eps.append(np.array([int(done)]).reshape(1, 1))
     
     def clear(self):
-        self.obs = []
-        self.act = []
-        self.rwd = []
-        self.next_obs = []
-        self.done = []
-
-        self.eps_len = []
         self.num_eps = 0
         self.size = 0
+        self.ptr = 0
+        self.eps_head = 0
         
     def push(self, obs=None, act=None, rwd=None, next_obs=None, done=None):
         """ Store episode data to buffer """
@@ -250,31 +851,38 @@ class EpisodeReplayBuffer:
             next_obs = np.vstack(self.next_obs_eps)
             rwd = np.vstack(self.rwd_eps)
             done = np.vstack(self.done_eps)            
-
-        # stack episode at the top of the buffer
-        self.obs.insert(0, obs)
-        self.act.insert(0, act)
-        self.rwd.insert(0, rwd)
-        self.next_obs.insert(0, next_obs)
-        self.done.insert(0, done)
-
-        self.eps_len.insert(0, len(obs))
+        
         self.update_stats(obs, rwd)
 
-        # update self size
+        # only keep the last max_size transitions of long episodes
+        eps_len = min(len(obs), self.max_size)
+        data = [
+            obs.reshape(-1, self.obs_dim)[-eps_len:], 
+            act.reshape(-1, self.act_dim)[-eps_len:], 
+            rwd.reshape(-1, 1)[-eps_len:], 
+            next_obs.reshape(-1, self.obs_dim)[-eps_len:], 
+            done.reshape(-1, 1)[-eps_len:],
+        ]
+
+        # evict oldest episodes
+        while self.size + eps_len > self.max_size:
+            self.size -= self.eps_len[self.eps_head]
+            self.eps_head = (self.eps_head + 1) % self.max_size
+            self.num_eps -= 1
+
+        # write episode with wrap around
+        num_tail = min(eps_len, self.max_size - self.ptr)
+        for storage, x in zip([self.obs, self.act, self.rwd, self.next_obs, self.done], data):
+            storage[self.ptr:self.ptr+num_tail] = x[:num_tail]
+            storage[:eps_len-num_tail] = x[num_tail:]
+        
+        eps_idx = (self.eps_head + self.num_eps) % self.max_size
+        self.eps_start[eps_idx] = self.ptr
+        self.eps_len[eps_idx] = eps_len
+        
+        self.ptr = (self.ptr + eps_len) % self.max_size
         self.num_eps += 1
-        self.size += len(obs)
-        if self.size > self.max_size:
-            while self.size > self.max_size:
-                self.obs = self.obs[:-1]
-                self.act = self.act[:-1]
-                self.rwd = self.rwd[:-1]
-                self.next_obs = self.next_obs[:-1]
-                self.done = self.done[:-1]
-
-                self.size -= len(self.obs[-1])
-                self.eps_len = self.eps_len[:-1]
-                self.num_eps = len(self.eps_len)
+        self.size += eps_len
         
         # clear episode
         self.obs_eps = []
@@ -283,7 +891,7 @@ class EpisodeReplayBuffer:
         self.next_obs_eps = []
         self.done_eps = []
 
-    def sample(self, batch_size, prioritize=False, ratio=100):
+    def sample(self, batch_size, prioritize=False, ratio=100, replace=False):
         """ Sample random transitions 
         
         Args:
@@ -291,30 +899,26 @@ class EpisodeReplayBuffer:
             prioritize (bool, optional): whether to perform prioritized sampling. Default=False
             ratio (int, optional): prioritization ratio. 
                 Sample from the latest batch_size * ratio transitions. Deafult=100
+            replace (bool, optional): whether to sample with replacement. Default=False
         """ 
-        obs = np.vstack(self.obs)
-        act = np.vstack(self.act)
-        rwd = np.vstack(self.rwd)
-        next_obs = np.vstack(self.next_obs)
-        done = np.vstack(self.done)
-        
         # prioritize new data for sampling
         if prioritize:
             max_samples = min(self.size, batch_size * ratio)
-            idx = np.random.choice(np.arange(max_samples), min(batch_size, max_samples), replace=False)
+            idx = self.ptr - 1 - sample_idx(self.rng, max_samples, batch_size, replace=replace)
         else:
-            idx = np.random.choice(np.arange(self.size), min(batch_size, self.size), replace=False)
+            idx = self.ptr - self.size + sample_idx(self.rng, self.size, batch_size, replace=replace)
+        idx = idx % self.max_size
         
         batch = dict(
-            obs=obs[idx], 
-            act=act[idx], 
-            rwd=rwd[idx], 
-            next_obs=next_obs[idx], 
-            done=done[idx],
+            obs=self.obs[idx], 
+            act=self.act[idx], 
+            rwd=self.rwd[idx], 
+            next_obs=self.next_obs[idx], 
+            done=self.done[idx],
         )
         return {k: torch.from_numpy(v).to(torch.float32) for k, v in batch.items()}
     
-    def sample_episodes(self, batch_size, prioritize=False, ratio=2):
+    def sample_episodes(self, batch_size, prioritize=False, ratio=2, packed=False):
         """ Sample complete episodes with zero sequence padding 
 
         Args:
@@ -322,20 +926,44 @@ class EpisodeReplayBuffer:
             prioritize (bool, optional): whether to perform prioritized sampling. Default=False
             ratio (int, optional): prioritization ratio. 
                 Sample from the latest batch_size * ratio episodes. Deafult=100
+            packed (bool, optional): whether to return concatenated episodes and offsets in the format of pack_fn 
+                instead of padded episodes and mask. Default=False
         """
+        # episode age rank, 0 is the latest episode
         if prioritize:
             max_samples = min(self.num_eps, batch_size * ratio)
-            idx = np.random.choice(np.arange(max_samples), min(batch_size, max_samples), replace=False)
+            rank = sample_idx(self.rng, max_samples, batch_size)
         else:
-            idx = np.random.choice(np.arange(self.num_eps), min(batch_size, self.num_eps), replace=False)
+            rank = sample_idx(self.rng, self.num_eps, batch_size)
+        eps_idx = (self.eps_head + self.num_eps - 1 - rank) % self.max_size
         
+        if packed:
+            eps_len = self.eps_len[eps_idx]
+            offsets = np.concatenate([[0], np.cumsum(eps_len)])
+            eps_id = np.repeat(np.arange(len(eps_idx)), eps_len)
+            step = np.arange(offsets[-1]) - offsets[eps_id]
+            idx = (self.eps_start[eps_idx][eps_id] + step) % self.max_size
+            
+            batch = dict(
+                obs=self.obs[idx], 
+                act=self.act[idx], 
+                rwd=self.rwd[idx], 
+                next_obs=self.next_obs[idx], 
+                done=self.done[idx],
+            )
+            batch = {k: torch.from_numpy(v).to(torch.float32) for k, v in batch.items()}
+            batch["eps_id"] = torch.from_numpy(eps_id)
+            batch["step"] = torch.from_numpy(step)
+            return batch, torch.from_numpy(offsets)
+
         batch = []
-        for i in idx:
-            obs = torch.from_numpy(self.obs[i]).to(torch.float32)
-            act = torch.from_numpy(self.act[i]).to(torch.float32)
-            rwd = torch.from_numpy(self.rwd[i]).to(torch.float32)
-            next_obs = torch.from_numpy(self.next_obs[i]).to(torch.float32)
-            done = torch.from_numpy(self.done[i]).to(torch.float32)
+        for start, eps_len in zip(self.eps_start[eps_idx], self.eps_len[eps_idx]):
+            idx = (start + np.arange(eps_len)) % self.max_size
+            obs = torch.from_numpy(self.obs[idx]).to(torch.float32)
+            act = torch.from_numpy(self.act[idx]).to(torch.float32)
+            rwd = torch.from_numpy(self.rwd[idx]).to(torch.float32)
+            next_obs = torch.from_numpy(self.next_obs[idx]).to(torch.float32)
+            done = torch.from_numpy(self.done[idx]).to(torch.float32)
             
             batch.append({
                 "obs": obs, 
@@ -350,13 +978,13 @@ class EpisodeReplayBuffer:
 
     def update_stats(self, obs, rwd):
         """ Update observation and reward moving mean and variance """
-        self.obs_mean, self.obs_mean_square, self.obs_variance = update_moving_stats(
-            obs, self.obs_mean, self.obs_mean_square, self.obs_variance, self.size, self.momentum
-        )
-
-        self.rwd_mean, self.rwd_mean_square, self.rwd_variance = update_moving_stats(
-            rwd, self.rwd_mean, self.rwd_mean_square, self.rwd_variance, self.size, self.momentum
-        )
+        self.obs_stats.update(obs)
+        self.rwd_stats.update(rwd)
+        
+        self.obs_mean = self.obs_stats.mean
+        self.obs_variance = self.obs_stats.variance
+        self.rwd_mean = self.rwd_stats.mean
+        self.rwd_variance = self.rwd_stats.variance
 
 
 class Logger():
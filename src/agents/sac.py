@@ -9,8 +9,8 @@ import torch.distributions as torch_dist
 import torch.distributions.transforms as torch_transform
 
 # model imports
-from src.agents.nn_models import MLP, DoubleQNetwork
-from src.agents.rl_utils import ReplayBuffer, Logger
+from src.agents.nn_models import MLP, DoubleQNetwork, EnsembleQNetwork
+from src.agents.rl_utils import ReplayBuffer, TorchReplayBuffer, PrioritizedReplayBuffer, Logger
 
 class TanhTransform(torch_transform.Transform):
     """ Adapted from Pytorch implementation with clipping """
@@ -57,7 +57,12 @@ class SAC(nn.Module):
         lr_a=1e-3, 
         lr_c=1e-3, 
         grad_clip=None,
-        device=torch.device("cpu")
+        device=torch.device("cpu"),
+        buffer_on_device=False,
+        prioritized_replay=False,
+        ensemble_critic=False,
+        num_critics=2,
+        num_min_critics=2,
         ):
         """
         Args:
@@ -78,8 +83,17 @@ class SAC(nn.Module):
             lr_c (float, optional): critic learning rate. Default=1e-3
             grad_clip (float, optional): gradient clipping. Default=None
             device (optional): training device. Default=cpu
+            buffer_on_device (bool, optional): whether to store replay buffer as tensors on device. Default=False
+            prioritized_replay (bool, optional): whether to sample replay buffer proportional to td error. Default=False
+            ensemble_critic (bool, optional): whether to compute all critics in one batched ensemble network. 
+                This is not faster than two separate critics on CPU, see scripts/benchmark_nn_models.py. Default=False
+            num_critics (int, optional): number of ensemble critics. Only used if ensemble_critic=True. Default=2
+            num_min_critics (int, optional): size of the random critic subset to take the minimum over in the critic target. 
+                A new subset is drawn for every target. If num_min_critics < num_critics, the actor maximizes the mean 
+                over all critics as in REDQ, otherwise the minimum over all critics. Only used if ensemble_critic=True. Default=2
         """
         super().__init__()
+        assert not (buffer_on_device and prioritized_replay), "prioritized replay buffer is not supported on device"
         self.obs_dim = obs_dim
         self.act_dim = act_dim
         self.act_lim = act_lim.to(device)
@@ -96,12 +110,19 @@ class SAC(nn.Module):
         self.lr_c = lr_c
         self.grad_clip = grad_clip
         self.device = device
+        self.buffer_on_device = buffer_on_device
+        self.prioritized_replay = prioritized_replay
         
         self.log_beta = nn.Parameter(np.log(beta) * torch.ones(1), requires_grad=tune_beta)
         self.actor = MLP(obs_dim, act_dim * 2, hidden_dim, num_hidden, activation)
-        self.critic = DoubleQNetwork(
-            obs_dim, act_dim, hidden_dim, num_hidden, activation
-        )
+        if ensemble_critic:
+            self.critic = EnsembleQNetwork(
+                obs_dim, act_dim, hidden_dim, num_hidden, activation, num_critics, num_min_critics
+            )
+        else:
+            self.critic = DoubleQNetwork(
+                obs_dim, act_dim, hidden_dim, num_hidden, activation
+            )
         self.critic_target = deepcopy(self.critic)
 
         # freeze target parameters
@@ -120,7 +141,12 @@ class SAC(nn.Module):
             )
         }
         
-        self.replay_buffer = ReplayBuffer(obs_dim, act_dim, buffer_size, momentum=0.99)
+        if buffer_on_device:
+            self.replay_buffer = TorchReplayBuffer(obs_dim, act_dim, buffer_size, momentum=0.99, device=device)
+        elif prioritized_replay:
+            self.replay_buffer = PrioritizedReplayBuffer(obs_dim, act_dim, buffer_size, momentum=0.99)
+        else:
+            self.replay_buffer = ReplayBuffer(obs_dim, act_dim, buffer_size, momentum=0.99)
         
         self.plot_keys = ["eval_eps_return_avg", "eval_eps_len_avg", "critic_loss_avg", "actor_loss_avg", "beta_avg"]
     
@@ -156,7 +182,7 @@ class SAC(nn.Module):
             a, _ = self.sample_action(obs, sample_mean)
         return a
 
-    def compute_critic_loss(self, batch, rwd_fn=None):
+    def compute_critic_loss(self, batch, rwd_fn=None, return_td_error=False):
         obs = batch["obs"].to(self.device)
         act = batch["act"].to(self.device)
         r = batch["rwd"].to(self.device)
@@ -171,15 +197,23 @@ class SAC(nn.Module):
             next_act, logp = self.sample_action(next_obs)
 
             # compute value target
-            q1_next, q2_next = self.critic_target(next_obs, next_act)
-            q_next = torch.min(q1_next, q2_next)
+            q_next = self.critic_target.compute_min_q(next_obs, next_act)
             v_next = q_next - self.beta * logp
             q_target = r + (1 - done) * self.gamma * v_next
         
-        q1, q2 = self.critic(obs, act)
-        q1_loss = torch.pow(q1 - q_target, 2).mean()
-        q2_loss = torch.pow(q2 - q_target, 2).mean()
-        q_loss = (q1_loss + q2_loss) / 2 
+        # importance weights of prioritized samples
+        weight = 1.
+        if "weight" in batch:
+            weight = batch["weight"].to(self.device)
+
+        # average loss over critics
+        q = self.critic.compute_q(obs, act)
+        q_error = q - q_target.unsqueeze(-2)
+        q_loss = torch.mean(weight * torch.pow(q_error, 2).mean(-2))
+        
+        if return_td_error:
+            td_error = torch.abs(q_error).mean(-2).detach()
+            return q_loss, td_error
         return q_loss
     
     def compute_actor_loss(self, batch):
@@ -187,8 +221,7 @@ class SAC(nn.Module):
         
         act, logp = self.sample_action(obs)
         
-        q1, q2 = self.critic(obs, act)
-        q = torch.min(q1, q2)
+        q = self.critic.compute_actor_q(obs, act)
 
         a_loss = torch.mean(self.beta * logp - q)
         beta_loss = -torch.mean(self.log_beta * (logp + self.beta_target).detach())
@@ -199,7 +232,14 @@ class SAC(nn.Module):
         self.critic.train()
         
         # train critic
-        critic_loss = self.compute_critic_loss(batch, rwd_fn)
+        if "idx" in batch:
+            critic_loss, td_error = self.compute_critic_loss(batch, rwd_fn, return_td_error=True)
+            
+            # only rows sampled from the prioritized buffer update priorities
+            priority_mask = batch["priority_mask"].to(td_error.device)
+            self.replay_buffer.update_priorities(batch["idx"], td_error[priority_mask])
+        else:
+            critic_loss = self.compute_critic_loss(batch, rwd_fn)
         critic_loss.backward()
         if self.grad_clip is not None:
             nn.utils.clip_grad_norm_(self.critic.parameters(), self.grad_clip)
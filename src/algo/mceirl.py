@@ -8,7 +8,7 @@ import torch.nn as nn
 from src.agents.sac import SAC
 from src.agents.nn_models import MLP
 from src.agents.rl_utils import EpisodeReplayBuffer, Logger
-from src.agents.rl_utils import collate_fn
+from src.agents.rl_utils import pack_fn, discounted_segment_sum
 
 class MCEIRL(SAC):
     """ Maximum causal entropy inverse reinforcement learning with soft actor critic solver """
@@ -75,36 +75,32 @@ class MCEIRL(SAC):
     def compute_reward(self, obs, act):
         return self.reward(torch.cat([obs, act], dim=-1)).clip(-8, 8)
     
-    def compute_reward_cumulents(self, obs, act, mask):
-        r = self.compute_reward(obs, act).squeeze(-1)
-        gamma = self.gamma ** torch.arange(obs.shape[0]).view(-1, 1)
-        rho = torch.sum(gamma * r * mask, dim=0)
+    def compute_reward_cumulents(self, batch, offsets):
+        """ Compute discounted reward sum of packed episodes """
+        r = self.compute_reward(batch["obs"], batch["act"]).squeeze(-1)
+        rho = discounted_segment_sum(r, batch["eps_id"], batch["step"], len(offsets) - 1, self.gamma)
         return rho
 
-    def compute_reward_loss(self, fake_batch, fake_mask):
-        real_batch, real_mask = self.real_buffer.sample_episodes(self.d_batch_size, prioritize=False)
-        
-        real_obs = real_batch["obs"]
-        real_act = real_batch["act"]
-
-        fake_obs = fake_batch["obs"]
-        fake_act = fake_batch["act"]
+    def compute_reward_loss(self, fake_batch, fake_offsets):
+        real_batch, real_offsets = self.real_buffer.sample_episodes(
+            self.d_batch_size, prioritize=False, packed=True
+        )
 
-        r_cum_real = self.compute_reward_cumulents(real_obs, real_act, real_mask)
-        r_cum_fake = self.compute_reward_cumulents(fake_obs, fake_act, fake_mask)
+        r_cum_real = self.compute_reward_cumulents(real_batch, real_offsets)
+        r_cum_fake = self.compute_reward_cumulents(fake_batch, fake_offsets)
         r_loss = -(r_cum_real.mean() - r_cum_fake.mean())
         return r_loss
 
     def take_reward_gradient_step(self, fake_batch, logger=None):
         self.reward.train()
         
-        # pad fake traj
-        fake_batch, fake_mask = collate_fn(fake_batch)
+        # pack fake traj
+        fake_batch, fake_offsets = pack_fn(fake_batch)
 
         reward_loss_epoch = []
         for i in range(self.d_steps):
             # train reward
-            reward_loss = self.compute_reward_loss(fake_batch, fake_mask)
+            reward_loss = self.compute_reward_loss(fake_batch, fake_offsets)
             reward_total_loss = reward_loss 
             reward_total_loss.backward()
 
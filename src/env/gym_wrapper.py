@@ -1,4 +1,6 @@
+from abc import ABC, abstractmethod
 import numpy as np
+import torch
 import gymnasium as gym
 from src.agents.rl_utils import normalize, denormalize
 
@@ -27,26 +29,92 @@ class GymEnv(gym.Env):
         self.env.close()
 
 
-class HopperTermination:
+class Termination(ABC):
+    """ Base termination function on torch tensors with observation denormalization """
     def __init__(self, obs_mean=0., obs_variance=1.):
-        self.obs_mean = obs_mean
-        self.obs_variance = obs_variance
+        self.obs_mean = torch.as_tensor(obs_mean, dtype=torch.float32)
+        self.obs_variance = torch.as_tensor(obs_variance, dtype=torch.float32)
     
+    def denormalize(self, next_obs):
+        if self.obs_mean.device != next_obs.device:
+            self.obs_mean = self.obs_mean.to(next_obs.device)
+            self.obs_variance = self.obs_variance.to(next_obs.device)
+        return denormalize(next_obs, self.obs_mean, self.obs_variance)
+    
+    @abstractmethod
+    def termination_fn(self, obs, act, next_obs):
+        """ Compute done flag on the device of the inputs
+
+        Args:
+            obs (torch.tensor): observations. size=[..., obs_dim]
+            act (torch.tensor): actions. size=[..., act_dim]
+            next_obs (torch.tensor): normalized next observations. size=[..., obs_dim]
+
+        Returns:
+            done (torch.tensor): boolean done flag. size=[...]
+        """
+
+
+class HopperTermination(Termination):
     def termination_fn(self, obs, act, next_obs):
-        next_obs = denormalize(next_obs.copy(), self.obs_mean, self.obs_variance)
+        next_obs = self.denormalize(next_obs)
         
         height = next_obs[..., 0]
         angle = next_obs[..., 1]
-        not_done = np.isfinite(next_obs).all(axis=-1) \
-                    * np.abs(next_obs[..., 1:] < 100).all(axis=-1) \
-                    * (height > .7) \
-                    * (np.abs(angle) < .2)
+        not_done = torch.isfinite(next_obs).all(dim=-1) \
+                    & (torch.abs(next_obs[..., 1:]) < 100).all(dim=-1) \
+                    & (height > .7) \
+                    & (torch.abs(angle) < .2)
 
         done = ~not_done
         return done
 
 
+class Walker2dTermination(Termination):
+    def termination_fn(self, obs, act, next_obs):
+        next_obs = self.denormalize(next_obs)
+        
+        height = next_obs[..., 0]
+        angle = next_obs[..., 1]
+        not_done = (height > 0.8) \
+                    & (height < 2.0) \
+                    & (angle > -1.0) \
+                    & (angle < 1.0)
+        
+        done = ~not_done
+        return done
+
+
+class HalfCheetahTermination(Termination):
+    def termination_fn(self, obs, act, next_obs):
+        return torch.zeros(next_obs.shape[:-1], dtype=torch.bool, device=next_obs.device)
+
+
+class AntTermination(Termination):
+    def termination_fn(self, obs, act, next_obs):
+        next_obs = self.denormalize(next_obs)
+        
+        height = next_obs[..., 0]
+        not_done = torch.isfinite(next_obs).all(dim=-1) \
+                    & (height >= 0.2) \
+                    & (height <= 1.0)
+
+        done = ~not_done
+        return done
+
+
+termination_fns = {
+    "Hopper": HopperTermination,
+    "Walker2d": Walker2dTermination,
+    "HalfCheetah": HalfCheetahTermination,
+    "Ant": AntTermination,
+}
+
 def get_termination_fn(env_name, obs_mean=0., obs_variance=1.):
-    if "Hopper" in env_name:
-        termination_fn = HopperTermination(obs_mean, obs_variance).termination_fn
-    return termination_fn
\ No newline at end of file
+    """ Get torch termination function by matching env_name to registered environments """
+    for name, termination in termination_fns.items():
+        if name in env_name:
+            return termination(obs_mean, obs_variance).termination_fn
+    raise ValueError(
+        f"no termination function registered for {env_name}, registered environments: {list(termination_fns.keys())}"
+    )